@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+Performance benchmarks (requires pytest-benchmark)
+
+    $ pytest benchmarks
+    $ pytest benchmarks --benchmark-autosave   # save the results
+    $ pytest benchmarks --benchmark-compare    # compare to the last saved results
+
+All the LUTs are synthetic, generated with a fixed seed.
+'''
+
+from __future__ import print_function, division, absolute_import
+import os
+import tempfile
+import numpy as np
+import pytest
+from luts import LUT, MLUT, Idx, merge, read_mlut
+
+pytest.importorskip('pytest_benchmark')
+
+
+def make_axis(n, regular=True):
+    '''
+    an axis of n values in [0, 1], regular or not
+    '''
+    if regular:
+        return np.linspace(0, 1, n)
+    else:
+        return np.linspace(0, 1, n)**2
+
+
+def make_lut(ndim, size=10, regular=True, dtype='float32'):
+    '''
+    a LUT of ndim dimensions of given size, named 'x0', 'x1'...
+    '''
+    rng = np.random.RandomState(0)
+    return LUT(rng.rand(*((size,)*ndim)).astype(dtype),
+               axes=[make_axis(size, regular) for _ in range(ndim)],
+               names=['x{}'.format(i) for i in range(ndim)])
+
+
+def make_mlut(ndatasets=4, ndim=3, size=20, attrs=None):
+    '''
+    a MLUT of ndatasets LUTs sharing the same axes
+    '''
+    rng = np.random.RandomState(0)
+    m = MLUT()
+    for i in range(ndim):
+        m.add_axis('x{}'.format(i), make_axis(size, regular=False))
+    for i in range(ndatasets):
+        m.add_dataset('data{}'.format(i),
+                      rng.rand(*((size,)*ndim)).astype('float32'),
+                      ['x{}'.format(j) for j in range(ndim)])
+    if attrs is not None:
+        m.set_attrs(attrs)
+    return m
+
+
+def make_values(npoints, ndim):
+    '''
+    ndim arrays of npoints random values in [0, 1]
+    '''
+    rng = np.random.RandomState(1)
+    return [rng.rand(npoints) for _ in range(ndim)]
+
+
+@pytest.mark.parametrize('ndim', [2, 4, 6])
+@pytest.mark.parametrize('npoints', [1, 1000, 100000])
+def test_getitem(benchmark, ndim, npoints):
+    lut = make_lut(ndim)
+    keys = tuple([Idx(v) for v in make_values(npoints, ndim)])
+    benchmark(lut.__getitem__, keys)
+
+
+@pytest.mark.parametrize('ndim', [2, 4])
+def test_getitem_slices(benchmark, ndim):
+    # interpolation of the first axis, other axes are kept
+    lut = make_lut(ndim, size=20)
+    keys = (Idx(make_values(100, 1)[0]),) + (slice(None),)*(ndim-1)
+    benchmark(lut.__getitem__, keys)
+
+
+@pytest.mark.parametrize('regular', [True, False])
+@pytest.mark.parametrize('npoints', [1, 1000, 1000000])
+def test_idx_index(benchmark, regular, npoints):
+    axis = make_axis(100, regular)
+    idx = Idx(make_values(npoints, 1)[0])
+    benchmark(idx.index, axis)
+
+
+@pytest.mark.parametrize('ndim', [2, 4])
+def test_binary_operation(benchmark, ndim):
+    # broadcasting a LUT on a subset of the axes of the other one
+    lut1 = make_lut(ndim, size=20)
+    lut2 = make_lut(ndim-1, size=20)
+    lut2.names = lut1.names[1:]
+    benchmark(lambda: lut1 + lut2)
+
+
+@pytest.mark.parametrize('ngroups', [None, 2, 50])
+def test_reduce(benchmark, ngroups):
+    lut = make_lut(3, size=100)
+    if ngroups is None:
+        grouping = None
+    else:
+        grouping = np.arange(100) % ngroups
+    benchmark(lut.reduce, np.sum, 'x1', grouping=grouping)
+
+
+@pytest.mark.parametrize('nmluts', [10, 100])
+def test_merge(benchmark, nmluts):
+    M = [make_mlut(ndatasets=2, ndim=2, size=20, attrs={'a': i % 5, 'b': i//5})
+         for i in range(nmluts)]
+    benchmark(merge, M, ['a', 'b'])
+
+
+@pytest.mark.parametrize('fmt', ['netcdf4', 'hdf4', 'mmap'])
+def test_save_read_mlut(benchmark, fmt):
+    if fmt == 'hdf4':
+        pytest.importorskip('pyhdf')
+    m = make_mlut(ndatasets=4, ndim=3, size=50)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'mlut')
+
+        def roundtrip():
+            m.save(filename, fmt=fmt, overwrite=True)
+            return read_mlut(filename, fmt=fmt)
+
+        benchmark(roundtrip)
+
+
+@pytest.mark.parametrize('fmt', ['netcdf4', 'mmap'])
+def test_read_mlut_sub(benchmark, fmt):
+    m = make_mlut(ndatasets=4, ndim=3, size=50)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'mlut')
+        m.save(filename, fmt=fmt)
+        benchmark(read_mlut, filename, fmt=fmt, datasets=['data0'],
+                  sub={'x0': Idx(0.5)})
@@ -1 +1 @@
-from .luts import LUT, MLUT, Idx, merge, read_mlut, read_mlut_hdf, from_xarray
\ No newline at end of file
+from .luts import LUT, MLUT, Idx, merge, merge_files, read_mlut, read_mlut_hdf, from_xarray
\ No newline at end of file
@@ -16,6 +16,9 @@ Provides:
 
 from __future__ import print_function, division, absolute_import
 import sys
+import os
+import multiprocessing
+import functools
 import numpy as np
 from scipy.interpolate import interp1d
 import xarray as xr
@@ -25,6 +28,13 @@ from collections import OrderedDict
 from numpy.ma import filled
 import warnings
 import itertools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# the hdf4, hdf5 and netcdf4 libraries are not thread-safe: the file
+# operations are serialized by this lock
+FILE_LOCK = threading.RLock()
 if sys.version_info[:2] >= (3, 0): # python2/3 compatibility
     unicode = str
     xrange = range
@@ -65,6 +75,413 @@ def uniq(seq):
     return [ x for x in seq if not (x in seen or seen_add(x))]
 
 
+def grouped_reduce(values, fn, axis, grouping, **kwargs):
+    '''
+    Apply the reducer fn to values along axis, by groups of identical values
+    in grouping (see LUT.reduce), with segment reductions: the axis is
+    sorted once by group, and each group is reduced with ufunc.reduceat
+
+    Supported reducers: np.sum, np.mean, np.min (np.amin), np.max (np.amax),
+    np.average (optionally with 1-d weights along axis)
+
+    Returns (reduced values, list of unique values of grouping in order of
+    appearance), or None if fn, kwargs or grouping are not supported.
+    '''
+    grouping = np.asarray(grouping)
+    if (grouping.ndim != 1) or (grouping.dtype.kind == 'O'):
+        return None
+    if (grouping.dtype.kind in ['f', 'c']) and np.isnan(grouping).any():
+        return None
+    weights = None
+    if (fn is np.average) and (set(kwargs) <= set(['weights'])):
+        weights = kwargs.get('weights')
+        if weights is not None:
+            weights = np.asarray(weights)
+            if weights.shape != grouping.shape:
+                return None
+    elif kwargs:
+        return None
+    ufuncs = {np.sum: np.add, np.min: np.minimum, np.max: np.maximum,
+              np.amin: np.minimum, np.amax: np.maximum,
+              np.mean: np.add, np.average: np.add}
+    if fn not in ufuncs:
+        return None
+
+    # group of each element, the groups being numbered in order of
+    # appearance
+    U, first, inverse = np.unique(grouping, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    groups = rank[inverse.reshape(-1)]
+
+    # sort the axis by group, and reduce each segment
+    perm = np.argsort(groups, kind='stable')
+    starts = np.searchsorted(groups[perm], np.arange(len(U)))
+    sorted_values = values.take(perm, axis=axis)
+    shp = [1]*values.ndim
+    shp[axis] = -1
+    if weights is not None:
+        w = weights[perm]
+        result = np.add.reduceat(sorted_values*w.reshape(shp), starts, axis=axis)
+        result /= np.add.reduceat(w, starts).reshape(shp)
+    else:
+        result = ufuncs[fn].reduceat(sorted_values, starts, axis=axis)
+        if fn in [np.mean, np.average]:
+            counts = np.diff(np.append(starts, len(groups)))
+            result = result/counts.reshape(shp)
+
+    return result, list(U[order])
+
+
+def reduce_corners(values, weights, out):
+    '''
+    Reduce the first dimension of values (the 2^n bracketing elements, in
+    the order of InterpPlan.corners) with the weights of the n interpolated
+    axes, and write the result to out
+    values is modified in place.
+    '''
+    # one interpolated axis at a time: lower + x*(upper - lower)
+    for x in weights[:-1]:
+        h = len(values)//2
+        upper = values[h:]
+        upper -= values[:h]
+        upper *= x
+        upper += values[:h]
+        values = upper
+    np.subtract(values[1], values[0], out=out)
+    out *= weights[-1]
+    out += values[0]
+
+    return out
+
+
+def flat_view(data):
+    '''
+    Returns a 1-d view on the memory of ndarray data, and the strides of data
+    in number of elements, such that data[i, j, ...] is
+    flat[i*strides[0] + j*strides[1] + ...]
+    Returns (None, None) if such a view is not possible (not an ndarray,
+    negative strides...)
+    '''
+    if (not isinstance(data, np.ndarray)) or (data.size == 0):
+        return None, None
+    itemsize = data.itemsize
+    if [s for s in data.strides if (s < 0) or (s % itemsize)]:
+        return None, None
+    strides = tuple(s//itemsize for s in data.strides)
+    size = 1 + sum([(n-1)*s for (n, s) in zip(data.shape, strides)])
+    flat = np.lib.stride_tricks.as_strided(data, shape=(size,),
+                                           strides=(itemsize,),
+                                           writeable=False)
+    return flat, strides
+
+
+def default_formatter(dtype):
+    '''
+    Returns the format of the values of a LUT of type dtype
+    '''
+    if dtype in [float, np.float32, np.float64]:
+        return '{:3g}'
+    else:
+        return '{}'
+
+
+def is_interpolated(k):
+    '''
+    Whether the key k of LUT.__getitem__ may result in an interpolation
+    (Idx with array-like values, float or float array)
+    '''
+    return (isinstance(k, (Idx_arr, float))
+            or (isinstance(k, np.ndarray)
+                and (k.dtype in [np.dtype('float32'), np.dtype('float64')])))
+
+
+def hyperslab(keys, shape):
+    '''
+    Split the indexing of an array of given shape by keys (one key per
+    dimension, with numpy semantics) into:
+        - the slices of the hyperslab containing all the indexed elements
+        - the keys to apply to this hyperslab, which give the same result as
+          the keys applied to the whole array
+
+    Float keys (floating point indices, see LUT.__getitem__) are bracketed
+    by the hyperslab.
+
+    Returns (slab, local_keys)
+    '''
+    slab = []
+    local = []
+    for k, n in zip(keys, shape):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(n)
+            if step > 0:
+                slab.append(k)
+                local.append(slice(None))
+            else:
+                r = xrange(start, stop, step)
+                if len(r) == 0:
+                    slab.append(slice(0, 0))
+                    local.append(slice(None))
+                else:
+                    slab.append(slice(r[-1], r[0]+1))
+                    local.append(slice(r[0]-r[-1], None, step))
+            continue
+
+        a = np.asarray(k)
+        if (a.dtype.kind == 'f') and (a.size > 0) and np.isfinite(a).all():
+            # floating point index: bracketing elements floor(k) and floor(k)+1
+            lo, hi = a.min(), a.max()
+            if (lo >= 0) and (hi <= n-1):
+                lo = max(min(int(lo), n-2), 0)
+                slab.append(slice(lo, min(int(hi)+2, n)))
+                if isinstance(k, float):
+                    local.append(k - lo)
+                else:
+                    local.append(np.asarray(a - lo))
+                continue
+        elif (a.dtype.kind in ['i', 'u']) and (a.size > 0):
+            if (a.min() >= -n) and (a.max() < n):
+                a = a % n
+                lo = int(a.min())
+                slab.append(slice(lo, int(a.max())+1))
+                if a.ndim == 0:
+                    local.append(int(a) - lo)
+                else:
+                    local.append(a - lo)
+                continue
+
+        # other cases (out of bounds, boolean arrays...): whole dimension
+        slab.append(slice(None))
+        local.append(k)
+
+    return slab, local
+
+
+# memory-mappable MLUT format (see MLUT.save and read_mlut_mmap):
+#   - magic string (8 bytes)
+#   - size of the header (uint64, little endian)
+#   - header: json description of the axes, datasets and attributes
+#     (see encode_attr for the encoding of the attributes)
+#   - raw C-ordered arrays, each starting at a multiple of MMAP_ALIGN bytes
+MMAP_MAGIC = b'MLUTMMAP'
+MMAP_ALIGN = 64
+
+
+def encode_attr(value):
+    '''
+    Encode an attribute value for json (see decode_attr), keeping the numpy
+    arrays and scalars (with their dtype), tuples and bytes
+    '''
+    if isinstance(value, np.ndarray):
+        return OrderedDict([('__ndarray__', value.tolist()),
+                            ('dtype', value.dtype.str),
+                            ('shape', value.shape)])
+    elif isinstance(value, np.generic):
+        return OrderedDict([('__numpy__', value.item()),
+                            ('dtype', value.dtype.str)])
+    elif isinstance(value, tuple):
+        return OrderedDict([('__tuple__', [encode_attr(v) for v in value])])
+    elif isinstance(value, bytes):
+        return OrderedDict([('__bytes__', value.decode('latin-1'))])
+    elif isinstance(value, list):
+        return [encode_attr(v) for v in value]
+    elif isinstance(value, dict):
+        return OrderedDict([(k, encode_attr(v)) for (k, v) in value.items()])
+    else:
+        return value
+
+
+def decode_attr(pairs):
+    '''
+    Decode the json objects encoded by encode_attr (object_pairs_hook for
+    json.loads)
+    '''
+    obj = OrderedDict(pairs)
+    if '__ndarray__' in obj:
+        return np.array(obj['__ndarray__'], dtype=obj['dtype']).reshape(obj['shape'])
+    elif '__numpy__' in obj:
+        return np.dtype(obj['dtype']).type(obj['__numpy__'])
+    elif '__tuple__' in obj:
+        return tuple(obj['__tuple__'])
+    elif '__bytes__' in obj:
+        return obj['__bytes__'].encode('latin-1')
+    else:
+        return obj
+
+
+def mmap_header_bytes(header):
+    '''
+    Encode the header of a file in mmap format
+    '''
+    header = OrderedDict(header)
+    header['datasets'] = [OrderedDict(desc) for desc in header['datasets']]
+    for desc in header['datasets']:
+        desc['attrs'] = encode_attr(desc['attrs'])
+    header['attrs'] = encode_attr(header['attrs'])
+
+    return json.dumps(header).encode('utf-8')
+
+
+def init_mmap(filename, axes, datasets, attrs):
+    '''
+    Create a MLUT file in mmap format (see read_mlut_mmap), with the axes and
+    uninitialized (zero) datasets
+
+    axes: list of (name, values)
+    datasets: list of (name, shape, dtype, axnames, attrs)
+    attrs: global attributes
+
+    Returns the datasets as writable numpy.memmap
+    '''
+    # description of the arrays, with their offset relative to the
+    # beginning of the data section
+    header = OrderedDict([('axes', []), ('datasets', []), ('attrs', attrs)])
+    size = 0
+    for name, ax in axes:
+        ax = np.asarray(ax)
+        header['axes'].append(OrderedDict([
+            ('name', name), ('dtype', ax.dtype.str),
+            ('shape', ax.shape), ('offset', size)]))
+        size += -(-ax.nbytes//MMAP_ALIGN)*MMAP_ALIGN
+    for name, shape, dtype, axnames, dattrs in datasets:
+        dtype = np.dtype(dtype)
+        header['datasets'].append(OrderedDict([
+            ('name', name), ('dtype', dtype.str),
+            ('shape', tuple(shape)), ('offset', size),
+            ('axnames', axnames), ('attrs', dattrs)]))
+        size += -(-dtype.itemsize*int(np.prod(shape))//MMAP_ALIGN)*MMAP_ALIGN
+
+    header_bytes = mmap_header_bytes(header)
+    start = -(-(len(MMAP_MAGIC) + 8 + len(header_bytes))//MMAP_ALIGN)*MMAP_ALIGN
+
+    with open(filename, 'wb') as fp:
+        fp.write(MMAP_MAGIC)
+        fp.write(np.array(len(header_bytes), dtype='<u8').tobytes())
+        fp.write(header_bytes)
+        for (name, ax), desc in zip(axes, header['axes']):
+            fp.seek(start + desc['offset'])
+            np.asarray(ax).tofile(fp)
+        fp.truncate(start + size)
+
+    return [mmap_array(filename, desc, start, mode='r+')
+            for desc in header['datasets']]
+
+
+def mmap_array(filename, desc, start, mode='r'):
+    '''
+    Returns the array described by desc (from the header of a file in mmap
+    format) as a numpy.memmap
+    '''
+    shape = tuple(desc['shape'])
+    dtype = np.dtype(desc['dtype'])
+    if dtype.itemsize*int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode=mode, shape=shape,
+                     offset=start+desc['offset'])
+
+
+def read_mmap_header(filename):
+    '''
+    Returns the header of a file in mmap format, and the offset of the data
+    section
+    '''
+    with open(filename, 'rb') as fp:
+        magic = fp.read(len(MMAP_MAGIC))
+        if magic != MMAP_MAGIC:
+            raise Exception('{} is not a MLUT in mmap format'.format(filename))
+        size = int(np.frombuffer(fp.read(8), dtype='<u8')[0])
+        header = json.loads(fp.read(size).decode('utf-8'),
+                            object_pairs_hook=decode_attr)
+    start = -(-(len(MMAP_MAGIC) + 8 + size)//MMAP_ALIGN)*MMAP_ALIGN
+
+    return header, start
+
+
+def set_mmap_attrs(filename, attrs):
+    '''
+    Replace the global attributes of a file in mmap format
+    The new header should not be larger than the initial one.
+    '''
+    header, start = read_mmap_header(filename)
+    header['attrs'] = attrs
+    header_bytes = mmap_header_bytes(header)
+    size = start - len(MMAP_MAGIC) - 8
+    if len(header_bytes) > size:
+        raise Exception('Cannot replace the attributes of {}: header is too '
+                        'large'.format(filename))
+
+    with open(filename, 'r+b') as fp:
+        fp.seek(len(MMAP_MAGIC))
+        # the header is padded with spaces
+        fp.write(np.array(size, dtype='<u8').tobytes())
+        fp.write(header_bytes.ljust(size))
+
+
+def init_chunked(filename, fmt, axes, datasets, nchunked):
+    '''
+    Create a MLUT file in netcdf4 or hdf5 format (see read_mlut_netcdf4 and
+    read_mlut_hdf5), with the axes and uninitialized datasets
+
+    The datasets are chunked by slabs of a single element along their
+    nchunked first dimensions, and of their full size along the other ones.
+    They are not compressed.
+
+    axes: list of (name, values)
+    datasets: list of (name, shape, dtype, axnames, attrs)
+
+    Returns the open file, and the datasets as writable variables
+    '''
+    def chunks(shape):
+        return tuple([1]*nchunked + [max(n, 1) for n in shape[nchunked:]])
+
+    if fmt == 'netcdf4':
+        from netCDF4 import Dataset
+        with FILE_LOCK:
+            root = Dataset(filename, 'w', format='NETCDF4')
+            for name, ax in axes:
+                ax = np.asarray(ax)
+                root.createDimension(name, len(ax))
+                var = root.createVariable(name, ax.dtype, [name])
+                var[:] = ax
+            arrays = []
+            dummycount = 0
+            for name, shape, dtype, axnames, attrs in datasets:
+                axnames = list(axnames)
+                for i in xrange(len(axnames)):
+                    if axnames[i] is None:
+                        dummycount += 1
+                        axnames[i] = 'dummy{:d}'.format(dummycount)
+                        root.createDimension(axnames[i], shape[i])
+                var = root.createVariable(name, dtype, axnames,
+                                          chunksizes=chunks(shape),
+                                          fill_value=False)
+                var.setncatts(attrs)
+                arrays.append(var)
+
+    elif fmt == 'hdf5':
+        import h5py
+        root = h5py.File(filename, 'w')
+        for name, ax in axes:
+            root.create_dataset('axis/'+name, data=np.asarray(ax))
+        arrays = []
+        for name, shape, dtype, axnames, attrs in datasets:
+            if None in axnames:
+                raise Exception('Cannot write dataset {} without axis names '
+                                'in hdf5 format'.format(name))
+            dset = root.create_dataset('data/'+name, shape, dtype=dtype,
+                                       chunks=chunks(shape))
+            dset.attrs['dimensions'] = ','.join(axnames)
+            for k, v in attrs.items():
+                dset.attrs[k] = v
+            arrays.append(dset)
+
+    else:
+        raise ValueError('Invalid format {}'.format(fmt))
+
+    return root, arrays
+
+
 def bin_edges(x, min=None, max=None):
     '''
     calculate n+1 bin edges from n bin centers in x
@@ -150,6 +567,9 @@ class LUT(object):
     (80,)
     '''
 
+    __slots__ = ['data', 'desc', 'attrs', 'ndim', 'shape', 'axes', 'names',
+                 'formatter', 'axis_cache']
+
     def __init__(self, data, axes=None, names=None, desc=None, attrs=None):
         self.data = data
         self.desc = desc
@@ -184,12 +604,39 @@ class LUT(object):
             self.names = names
             assert len(names) == self.ndim
 
-        if self.data.dtype in [float, np.float32, np.float64]:
-            self.formatter = '{:3g}'
+        self.formatter = default_formatter(self.data.dtype)
+
+        # cache of AxisIndex (shared between the LUTs of a MLUT)
+        self.axis_cache = AxisCache()
+
+    def new(self, data, axes, names, attrs, desc, axis_cache=None):
+        '''
+        Returns a new LUT, without the checks of __init__, for the operations
+        whose result is known to be consistent (axes and names matching the
+        dimensions of data)
+        axes, names and attrs are shared by reference.
+        axis_cache: cache of AxisIndex shared with the new LUT (by default, a
+            new cache)
+        '''
+        lut = LUT.__new__(LUT)
+        lut.data = data
+        lut.desc = desc
+        lut.attrs = attrs
+        lut.ndim = data.ndim
+        lut.shape = data.shape
+        lut.axes = axes
+        lut.names = names
+        if data.dtype == self.data.dtype:
+            lut.formatter = self.formatter
         else:
-            self.formatter = '{}'
+            lut.formatter = default_formatter(data.dtype)
+        if axis_cache is None:
+            axis_cache = AxisCache()
+        lut.axis_cache = axis_cache
+
+        return lut
 
-    def sub(self, d=None, ignore=False):
+    def sub(self, d=None, ignore=False, copy=False):
         '''
         returns a subset LUT of current LUT along several axes
 
@@ -206,6 +653,11 @@ class LUT(object):
 
         * ignore: if True, return full LUT if axis is not present in LUT
 
+        * copy: if False (default), the data of the subset LUT is a view on the
+          data of the current LUT when possible (only integers and slices,
+          without interpolation), and no data is copied. Otherwise, the
+          subset LUT owns a copy of its data.
+
         Examples:
           lut.sub({'axis1': 1.5})
              returns the lut stripped from 'axis1', for which we use the index 1.5
@@ -225,6 +677,15 @@ class LUT(object):
             else:
                 raise Exception('Cannot subset scalar LUT {}'.format(self))
 
+        keys, axes, names = self.sub_keys(d, ignore=ignore)
+
+        return self.sub_lut(self[tuple(keys)], axes, names, copy=copy)
+
+    def sub_keys(self, d, ignore=False):
+        '''
+        Returns the keys of __getitem__ for subsetting the LUT with d, and the
+        axes and names of the subset (see sub)
+        '''
         keys = [slice(None)] * self.ndim
         names = list(self.names)
         axes = list(self.axes)
@@ -246,7 +707,10 @@ class LUT(object):
                                         'because this axis is not present '
                                         'in {}'.format(ax, self))
 
-            if isinstance(v, Idx_base):
+            if isinstance(v, Idx_arr):
+                idx = v.index(self.axes[iax], lookup=self.axis_index(iax))
+                newax = v.apply(self.axes[iax])
+            elif isinstance(v, Idx_base):
                 idx = v.index(self.axes[iax])
                 newax = v.apply(self.axes[iax])
             else:
@@ -278,10 +742,25 @@ class LUT(object):
         axes = [a for i, a in enumerate(axes) if not i in dims_to_remove]
         names = [a for i, a in enumerate(names) if not i in dims_to_remove]
 
-        data = self[tuple(keys)]
+        return keys, axes, names
 
-        return LUT(data, axes=axes, names=names,
-                   attrs=dict(self.attrs), desc=self.desc)
+    def sub_lut(self, data, axes, names, copy=False):
+        '''
+        Returns the subset LUT with data (the result of __getitem__ with the
+        keys of sub_keys), axes and names
+        '''
+        data = np.asanyarray(data)
+        if (copy and isinstance(self.data, np.ndarray)
+                and np.may_share_memory(data, self.data)):
+            data = data.copy()
+
+        lut = self.new(data, axes, names, dict(self.attrs), self.desc)
+
+        # keep the cached AxisIndex of the axes which are left unchanged
+        lut.axis_cache.update([(k, c) for (k, c) in self.axis_cache.items()
+                               if any([c[0] is ax for ax in axes])])
+
+        return lut
 
 
     def axis(self, a, aslut=False):
@@ -305,6 +784,22 @@ class LUT(object):
         else:
             return self.axes[index]
 
+    def axis_index(self, a):
+        '''
+        returns the AxisIndex of axis a (string or integer), for converting
+        values into floating point indices in this axis
+
+        The AxisIndex are cached per axis object, so that each axis is
+        analysed only once. Axes modified in place are not detected: in this
+        case, reset the cache with `lut.axis_cache.clear()`.
+        '''
+        if isinstance(a, str):
+            index = self.names.index(a)
+        else:
+            index = a
+
+        return self.axis_cache.index(self.axes[index], self.axes)
+
     def print_info(self, *args, **kwargs):
         # same as describe()
         return self.describe(*args, **kwargs)
@@ -380,97 +875,51 @@ class LUT(object):
 
         if not isinstance(keys, tuple):
             keys = (keys,)
-        keys = list(keys)
-        N = len(keys)
-
-        if N != self.ndim:
-            raise Exception('Incorrect number of dimensions in __getitem__ '
-                            '(expecting {}, got {})'.format(self.ndim, N))
-
-        # convert the Idx keys to float indices
-        for i in xrange(N):
-            k = keys[i]
-            if isinstance(k, Idx_base):
-                # k is an Idx instance
-                # convert it to float indices for the current axis
-                if k.name not in [None, self.names[i]]:
-                    msg = 'Error, wrong parameter passed at position {}, expected {}, got {}'
-                    raise Exception(msg.format(i, self.names[i], k.name))
-                keys[i] = k.index(self.axes[i])
-
-        # determine the dimensions of the result (for broadcasting coef)
-        dims_array = None
-        index0 = []
-        for i in xrange(N):
-            k = keys[i]
-            if isinstance(k, np.ndarray) and (k.ndim > 0):
-                index0.append(np.zeros_like(k, dtype='int'))
-                if dims_array is None:
-                    dims_array = k.shape
-                else:
-                    assert dims_array == k.shape, 'LUTS.__getitem__: all arrays must have same shape ({} != {})'.format(str(dims_array), str(k.shape))
-            elif isinstance(k, slice):
-                index0.append(k)
-            else:  # scalar
-                index0.append(0)
-
-        shp_res = np.zeros(1).reshape([1]*self.ndim)[tuple(index0)].shape
-
-        # determine the interpolation axes
-        # and for those axes, determine the lower index (inf) and the weight
-        # (x) between lower and upper index
-        interpolate_axis = []   # indices of the interpolated axes
-        inf_list = []       # index of the lower elements for the interpolated axes
-        x_list = []         # weights, for the interpolated axes
-        for i in xrange(N):
-            k = keys[i]
-
-            # floating-point indices should be interpolated
-            interpolate = False
-            if isinstance(k, np.ndarray) and (k.dtype in [np.dtype('float32'),
-                                                          np.dtype('float64')]):
-                interpolate = True
-                inf = k.astype('int')
-                inf[inf == self.data.shape[i]-1] -= 1
-                x = k-inf
-                if k.ndim > 0:
-                    x = x.reshape(shp_res)
-            elif isinstance(k, float):
-                interpolate = True
-                inf = int(k)
-                if inf == self.data.shape[i]-1:
-                    inf -= 1
-                x = k-inf
-            if interpolate:
-                # current axis needs interpolation
-                inf_list.append(inf)
-                x_list.append(x)
-                interpolate_axis.append(i)
-
-        # loop over the 2^n bracketing elements
-        # (cartesian product of [0, 1] over n dimensions)
-        n = len(interpolate_axis)
-        result = 0
-        for b in xrange(2**n):
-
-            # coefficient attributed to the current item
-            # and adjust the indices
-            # for the interpolated dimensions
-            coef = 1
-            for i in xrange(n):
-                # bb is the ith bit in b (0 or 1)
-                bb = ((1<<i)&b)>>i
-                x = x_list[i]
-                if bb:
-                    coef *= x
-                else:
-                    coef *= 1-x
+        if not any([is_interpolated(k) for k in keys]):
+            # no interpolation: plain indexing of the data
+            if len(keys) != self.ndim:
+                raise Exception('Incorrect number of dimensions in __getitem__ '
+                                '(expecting {}, got {})'.format(self.ndim, len(keys)))
+            keys = list(keys)
+            for i, k in enumerate(keys):
+                if isinstance(k, Idx_filter):
+                    if k.name not in [None, self.names[i]]:
+                        msg = 'Error, wrong parameter passed at position {}, expected {}, got {}'
+                        raise Exception(msg.format(i, self.names[i], k.name))
+                    keys[i] = k.index(self.axes[i])
+            return self.data[tuple(keys)]
+
+        return InterpPlan(self, keys)()
+
+    def interp(self, keys, engine='fused', chunk_size=None, workers=None):
+        '''
+        Interpolate the LUT at keys, like LUT.__getitem__, with options:
+            * engine: the interpolation engine, 'fused' or 'loop'
+            * chunk_size: process the arrays in keys by blocks of chunk_size
+              elements, to bound the memory usage with large arrays
+            * workers: number of threads for processing the blocks
 
-                keys[interpolate_axis[i]] = inf_list[i] + bb
+        See InterpPlan for details.
 
-            result += coef * self.data[tuple(keys)]
+        Example:
+        >>> P.interp((Idx(z), Idx(P0)), chunk_size=2**16)  # same as P[Idx(z), Idx(P0)]
+        >>> P.interp((Idx(z), Idx(P0)), workers=8)
+        '''
+        return InterpPlan(self, keys, engine=engine, chunk_size=chunk_size,
+                          workers=workers)()
 
-        return result
+    def plan(self, *keys, **kwargs):
+        '''
+        Returns an interpolation plan (InterpPlan) for repeated lookups into
+        this LUT with the same key structure as keys (see LUT.__getitem__)
+        kwargs are passed to InterpPlan (engine, chunk_size, workers)
+
+        Example:
+        >>> plan = P.plan(Idx(0., 'z'), Idx(1013.))
+        >>> plan(z1, P01)   # same as P[Idx(z1), Idx(P01)]
+        >>> plan(z2, P02)
+        '''
+        return InterpPlan(self, keys, **kwargs)
 
 
     def equal(self, other, strict=True):
@@ -549,19 +998,20 @@ class LUT(object):
         else:
             desc = str(fn)
 
-        return LUT(
-                fn(self.data[tuple(shp1)],
-                    other.data[tuple(shp2)]),
-                axes=axes, names=names,
-                attrs=attrs, desc=desc)
+        # (lazy data is read with np.asanyarray)
+        data = np.asanyarray(fn(np.asanyarray(self.data)[tuple(shp1)],
+                                np.asanyarray(other.data)[tuple(shp2)]))
+        return self.new(data, axes, names, attrs, desc)
 
 
     def __binary_operation_scalar__(self, other, fn):
-        return LUT(fn(self.data, other),
-                axes=self.axes, names=self.names,
-                attrs=self.attrs, desc=self.desc)
+        return self.new(np.asanyarray(fn(np.asanyarray(self.data), other)),
+                        self.axes, self.names, self.attrs, self.desc,
+                        axis_cache=self.axis_cache)
 
     def __binary_operation__(self, other, fn):
+        if isinstance(other, LUTExpr):
+            return fn(self.lazy(), other)
         if isinstance(other, LUT):
             return self.__binary_operation_lut__(other, fn)
         else:
@@ -597,6 +1047,57 @@ class LUT(object):
     def __rtruediv__(self, other):
         return self.__binary_operation__(other, lambda x, y: y/x)
 
+    def __inplace_operation__(self, other, ufunc, fn):
+        '''
+        apply ufunc(self, other) in place on the data of self, if the result
+        has the shape, the axes and the data type of self (other is a scalar,
+        an array or a LUT whose axes are a subset of the axes of self), and
+        if the data is a writeable ndarray. The attributes and description
+        of self are unchanged.
+        Otherwise, returns the out-of-place operation fn(self, other).
+
+        Note that the data may be shared with other LUTs or MLUTs (for
+        example, a LUT extracted from a MLUT), which are also modified.
+        '''
+        data = self.data
+        if not (isinstance(data, np.ndarray) and data.flags.writeable):
+            return self.__binary_operation__(other, fn)
+
+        if isinstance(other, LUT):
+            names = interleave_seq(self.names, other.names)
+            if list(names) != list(self.names):
+                # the result has more axes than self
+                return self.__binary_operation__(other, fn)
+            shp = [slice(None) if (a in other.names) else None for a in names]
+            operand = np.asanyarray(other.data)[tuple(shp)]
+        else:
+            operand = other
+
+        dtype = np.result_type(data, operand)
+        if (ufunc is np.true_divide) and (dtype.kind not in ['f', 'c']):
+            dtype = np.result_type(dtype, float)
+        if ((dtype == data.dtype)
+                and (np.broadcast_shapes(data.shape, np.shape(operand)) == data.shape)):
+            ufunc(data, operand, out=data)
+            return self
+        else:
+            return self.__binary_operation__(other, fn)
+
+    def __iadd__(self, other):
+        return self.__inplace_operation__(other, np.add, lambda x, y: x+y)
+
+    def __isub__(self, other):
+        return self.__inplace_operation__(other, np.subtract, lambda x, y: x-y)
+
+    def __imul__(self, other):
+        return self.__inplace_operation__(other, np.multiply, lambda x, y: x*y)
+
+    def __idiv__(self, other):
+        return self.__inplace_operation__(other, np.true_divide, lambda x, y: x/y)
+
+    def __itruediv__(self, other):
+        return self.__inplace_operation__(other, np.true_divide, lambda x, y: x/y)
+
     def __eq__(self, other):
         return self.equal(other)
 
@@ -634,9 +1135,23 @@ class LUT(object):
         '''
         if (desc is None) and (self.desc is not None):
             desc = self.desc
-        return LUT(fn(self.data),
-                axes=self.axes, names=self.names,
-                attrs=self.attrs, desc=desc)
+        return self.new(np.asanyarray(fn(np.asanyarray(self.data))),
+                        self.axes, self.names, self.attrs, desc,
+                        axis_cache=self.axis_cache)
+
+    def lazy(self):
+        '''
+        Returns a lazy expression (LUTExpr) of this LUT: the arithmetic
+        operations on this expression are not evaluated, but build an
+        expression, which can be evaluated in a single pass (LUTExpr.compute)
+        or only at some points (LUTExpr.__getitem__)
+
+        Example:
+        >>> E = (L1.lazy()*L2 + L3)/L4
+        >>> E.compute(chunk_size=2**20)       # a LUT
+        >>> E[Idx(x1), Idx(x2), Idx(x3)]      # interpolate the expression
+        '''
+        return LUTExpr(lut=self)
 
     def reduce(self, fn, axis, grouping=None, as_lut=False, **kwargs):
         '''
@@ -660,6 +1175,7 @@ class LUT(object):
             index = self.names.index(axis)
         else:
             index = axis
+        values = np.asanyarray(self.data)
 
         if grouping is None:
             axes = list(self.axes)
@@ -668,30 +1184,34 @@ class LUT(object):
             names.pop(index)
             if (self.ndim == 1) and (not as_lut):
                 # returns a scalar
-                return fn(self.data, axis=index, **kwargs)
+                return fn(values, axis=index, **kwargs)
             else:
                 # returns a LUT
-                return LUT(fn(self.data, axis=index, **kwargs),
-                        axes=axes, names=names,
-                        attrs=self.attrs, desc=self.desc)
+                return self.new(np.asanyarray(fn(values, axis=index, **kwargs)),
+                                axes, names, self.attrs, self.desc,
+                                axis_cache=self.axis_cache)
         else:
             assert len(grouping) == len(self.axes[index])
-            shp = list(self.data.shape)
-            U = uniq(grouping)
-            shp[index] = len(U)
-            data = np.zeros(shp, dtype=self.data.dtype)
-            ind1 = [slice(None),] * self.ndim
-            ind2 = [slice(None),] * self.ndim
-            for i, u in enumerate(U):
-                # fill each group
-                ind1[index] = i
-                ind2[index] = (grouping == u)
-                data[tuple(ind1)] = fn(self.data[tuple(ind2)], axis=index, **kwargs)
+            # segment reduction for the common reducers
+            res = grouped_reduce(values, fn, index, grouping, **kwargs)
+            if res is not None:
+                data, U = res
+                data = data.astype(self.data.dtype, copy=False)
+            else:
+                shp = list(self.data.shape)
+                U = uniq(grouping)
+                shp[index] = len(U)
+                data = np.zeros(shp, dtype=self.data.dtype)
+                ind1 = [slice(None),] * self.ndim
+                ind2 = [slice(None),] * self.ndim
+                for i, u in enumerate(U):
+                    # fill each group
+                    ind1[index] = i
+                    ind2[index] = (grouping == u)
+                    data[tuple(ind1)] = fn(values[tuple(ind2)], axis=index, **kwargs)
             axes = list(self.axes)
             axes[index] = U
-            return LUT(data,
-                    axes=axes, names=self.names,
-                    attrs=self.attrs, desc=self.desc)
+            return self.new(data, axes, self.names, self.attrs, self.desc)
 
 
     def swapaxes(self, axis1, axis2):
@@ -716,9 +1236,30 @@ class LUT(object):
         names[axis1], names[axis2] = names[axis2], names[axis1]
         axes[axis1], axes[axis2] = axes[axis2], axes[axis1]
 
-        return LUT(self.data.swapaxes(axis1, axis2),
-                   axes=axes, names=names,
-                   attrs=self.attrs, desc=self.desc)
+        return self.new(np.asanyarray(self.data).swapaxes(axis1, axis2),
+                        axes, names, self.attrs, self.desc,
+                        axis_cache=self.axis_cache)
+
+    def vector(self, axis):
+        '''
+        Returns a vector-valued LUT, where axis (int or str) is moved to the
+        last dimension, which is contiguous in memory
+
+        When interpolating this LUT with a slice on the last axis, the
+        bracketing elements are contiguous vectors, gathered all at once.
+
+        Example:
+        >>> V = L.vector('band')
+        >>> V[Idx(x1), Idx(x2), :]   # shape x1.shape + (nband,)
+        '''
+        if isinstance(axis, str):
+            axis = self.names.index(axis)
+        names = [n for (i, n) in enumerate(self.names) if i != axis] + [self.names[axis]]
+        axes = [a for (i, a) in enumerate(self.axes) if i != axis] + [self.axes[axis]]
+
+        return self.new(np.ascontiguousarray(np.moveaxis(np.asarray(self.data), axis, -1)),
+                        axes, names, self.attrs, self.desc,
+                        axis_cache=self.axis_cache)
 
 
     def plot(self, *args, **kwargs):
@@ -1051,8 +1592,15 @@ def Idx(value, name=None, round=False, fill_value=None):
     This allows verifying that the parameter is used in the right axis.
 
     Options:
-        - fill_value are passed to interp1d (implies bounds_error=False)
-          Special value for fill_value='extrema': fill with extrema values, don't extrapolate
+        - fill_value: behaviour for the values outside of the axis (the
+          indices are calculated by AxisIndex). Can be:
+            * None (default): raise a ValueError
+            * a scalar: index returned for all values out of the axis
+            * a 2-tuple: indices for the values below and above the axis
+            * 'extrapolate': extrapolate the index linearly
+            * 'extrema': fill with the indices of the extrema (first and
+              last index), don't extrapolate
+            * 'extrema,warn': same as 'extrema', with a warning
 
     NOTE: this function is a factory that returns an Idx_* instance based on input type
 
@@ -1066,89 +1614,1111 @@ def Idx(value, name=None, round=False, fill_value=None):
                        round=round, fill_value=fill_value)
 
 
-class Idx_base(object):
-    '''
-    Base class for Idx objects
-    '''
-    def __init__(self, value, name=None, round=False, fill_value=None):
-        if value is not None:
-            self.value = value
-            self.name = name
-            self.round = round
-            self.fill_value = fill_value
+class Idx_base(object):
+    '''
+    Base class for Idx objects
+    '''
+    def __init__(self, value, name=None, round=False, fill_value=None):
+        if value is not None:
+            self.value = value
+            self.name = name
+            self.round = round
+            self.fill_value = fill_value
+
+
+class Idx_arr(Idx_base):
+    '''
+    Idx class for array-like values
+    '''
+    def index(self, axis, lookup=None):
+        '''
+        Return the floating point index of the values in the axis
+        lookup: AxisIndex of this axis, if available (see LUT.axis_index)
+        '''
+        if lookup is None:
+            lookup = AxisIndex(axis)
+        return lookup.index(self.value, fill_value=self.fill_value,
+                            round=self.round, name=self.name)
+
+    def apply(self, axis=None):
+        return self.value
+
+class AxisIndex(object):
+    '''
+    Conversion of values into floating point indices in an axis, by linear
+    interpolation (used by Idx_arr.index)
+
+    The axis is analysed once, and the instance can be reused for many
+    lookups:
+        - regularly spaced axes use a closed form (value - first)/step
+        - other monotonic axes use a table of regular bins, giving for each
+          bin the first candidate interval, followed by a few comparisons
+          (or a binary search with numpy.searchsorted for small arrays of
+          values, or if the bins are too crowded)
+        - non-monotonic axes use scipy's interp1d
+
+    Example:
+    >>> AxisIndex(np.linspace(0, 100, 11)).index(35.)
+    array(3.5)
+    '''
+    def __init__(self, axis):
+        self.axis = axis
+        self.size = len(axis)
+        x = np.array(axis[:], dtype='float64')
+        self.decreasing = False
+        self.monotonic = True
+        self.step = None   # step of regularly spaced axes
+        self.bins = None   # bins table of irregularly spaced axes
+        if self.size > 1:
+            diff = np.diff(x)
+            if (diff < 0).all():
+                # work on the increasing axis
+                x = x[::-1]
+                diff = -diff[::-1]
+                self.decreasing = True
+            elif not (diff > 0).all():
+                self.monotonic = False
+            if self.monotonic:
+                step = (x[-1] - x[0])/(self.size - 1)
+                if (np.abs(diff - step) <= 1e-9*step).all():
+                    self.step = step
+                    self.inv_step = 1./step
+                else:
+                    self.__init_bins(x, diff)
+                self.inv_diff = 1./diff
+        self.x = x  # increasing axis if monotonic
+
+    def __init_bins(self, x, diff):
+        '''
+        Initialize the table of regular bins for an irregular increasing axis
+        '''
+        nbins = int(min(np.ceil((x[-1] - x[0])/np.amin(diff)), 64*self.size))
+        inv_width = nbins/(x[-1] - x[0])
+
+        # bins of the inner breakpoints, calculated like the bins of the
+        # values (monotonic transformation)
+        ibins = np.minimum(((x[1:-1] - x[0])*inv_width).astype(np.intp), nbins-1)
+        count = np.bincount(ibins, minlength=nbins)
+        nsteps = np.amax(count) if len(count) else 0
+        if nsteps > 4:
+            # crowded bins: use a binary search
+            return
+
+        self.bins = nbins
+        self.inv_width = inv_width
+        # index of the first candidate interval for each bin: number of
+        # breakpoints in the previous bins
+        self.bins_table = np.append(0, np.cumsum(count)[:nbins-1])
+        self.bins_steps = nsteps
+        # upper bounds of the intervals
+        self.upper = np.append(x[1:-1], np.inf)
+
+    def index(self, value, fill_value=None, round=False, name=None):
+        '''
+        Returns the floating point index of value in the axis (see Idx)
+        '''
+        if self.size == 1:
+            if not np.allclose(np.array(value), self.x[0]):
+                raise ValueError("(Idx) Out of axis value (value={}, axis={})".format(value, self.axis))
+            return 0
+
+        if isinstance(fill_value, str) and (fill_value == 'extrema'):
+            fv = (0, self.size-1)
+        elif isinstance(fill_value, str) and (fill_value == 'extrema,warn'):
+            fv = (0, self.size-1)
+            vmin, vmax = np.amin(self.x), np.amax(self.x)
+            if (np.amax(value) > vmax):
+                warnings.warn('(Idx) Value {} is above the axis maximum {} (axis {})'.format(
+                    np.amax(value), vmax, name))
+            if (np.amin(value) < vmin):
+                warnings.warn('(Idx) Value {} is under the axis minimum {} (axis {})'.format(
+                    np.amin(value), vmin, name))
+        else:
+            fv = fill_value
+
+        res = self.interp(value, fill_value=fv)
+        if round:
+            res = res.round().astype(int)
+        return res
+
+    def interp(self, value, fill_value=None):
+        '''
+        Returns the floating point indices of value in the axis, like
+        interp1d(axis, np.arange(len(axis)), bounds_error=(fill_value is None),
+                 fill_value=fill_value)(value)
+
+        fill_value can be None (values out of the axis raise a ValueError), a
+        scalar, a tuple (below, above) or 'extrapolate'.
+        '''
+        extrapolate = isinstance(fill_value, str) and (fill_value == 'extrapolate')
+        if (not self.monotonic) or not (
+                (fill_value is None) or extrapolate or np.isscalar(fill_value)
+                or (isinstance(fill_value, tuple) and (len(fill_value) == 2))):
+            return interp1d(self.axis, np.arange(self.size),
+                            bounds_error=(fill_value is None),
+                            fill_value=fill_value)(value)
+
+        v = np.asarray(value, dtype='float64')
+        shape = v.shape
+        v = v.reshape(-1)
+        x = self.x
+        n = self.size
+
+        # values out of the axis (NaNs are ignored)
+        outside = (not extrapolate) and (v.size > 0) and (
+            (np.fmin.reduce(v) < x[0]) or (np.fmax.reduce(v) > x[-1]))
+        if outside:
+            below = v < x[0]
+            above = v > x[-1]
+            if fill_value is None:
+                if below.any():
+                    raise ValueError("A value ({}) in x_new is below the "
+                                     "interpolation range's minimum value ({})."
+                                     .format(np.amin(v[below]), x[0]))
+                if above.any():
+                    raise ValueError("A value ({}) in x_new is above the "
+                                     "interpolation range's maximum value ({})."
+                                     .format(np.amax(v[above]), x[-1]))
+
+        if self.step is not None:
+            res = (v - x[0])*self.inv_step
+            if not extrapolate:
+                np.clip(res, 0, n-1, out=res)
+        else:
+            # index of the lower bracketing element
+            if (self.bins is not None) and (v.size > 256):
+                b = v - x[0]
+                b *= self.inv_width
+                with np.errstate(invalid='ignore'):  # NaNs
+                    b = b.astype(np.intp)
+                np.clip(b, 0, self.bins-1, out=b)
+                i = self.bins_table.take(b)
+                for _ in xrange(self.bins_steps):
+                    i += (v >= self.upper.take(i))
+            else:
+                i = np.clip(np.searchsorted(x, v), 1, n-1) - 1
+            res = v - x.take(i)
+            res *= self.inv_diff.take(i)
+            res += i
+
+        if self.decreasing:
+            res = (n-1) - res
+
+        if outside:
+            if isinstance(fill_value, tuple):
+                fill_below, fill_above = fill_value
+            else:
+                fill_below, fill_above = fill_value, fill_value
+            res[below] = fill_below
+            res[above] = fill_above
+
+        return res.reshape(shape)
+
+
+class AxisCache(dict):
+    '''
+    A cache of AxisIndex: {id(axis): (axis, AxisIndex)}
+
+    The entries of the axes which are no longer in use are dropped when a
+    new entry is stored. The axes in use are those of the owner (a MLUT
+    sharing its cache with its LUTs), or those passed to index if the cache
+    has no owner.
+    '''
+    def __init__(self, owner=None):
+        dict.__init__(self)
+        self.owner = owner
+
+    def index(self, axis, axes):
+        '''
+        returns the AxisIndex of axis (from the cache, or stored in the cache)
+        axes: axes in use
+        '''
+        cached = self.get(id(axis))
+        if (cached is None) or (cached[0] is not axis):
+            if self.owner is not None:
+                axes = list(self.owner.axes.values())
+            for k in [k for (k, c) in self.items()
+                      if not any([c[0] is ax for ax in axes])]:
+                self.pop(k)
+            cached = (axis, AxisIndex(axis))
+            self[id(axis)] = cached
+
+        return cached[1]
+
+
+class Idx_filter(Idx_base):
+    '''
+    Idx class for filtering functions
+    '''
+    def index(self, axis):
+        # value is a callable (function):
+        # returns value applied to axis
+        return self.value(axis)
+
+    def apply(self, axis):
+        return axis[self.index(axis)]
+
+
+class Idx_resolved(Idx_base):
+    '''
+    An Idx whose indices have been calculated for a given axis (see
+    MLUT.sub): they are reused for this axis object, and calculated by the
+    original Idx for the other axes
+
+    lookup: AxisIndex of the axis, if available
+    '''
+    def __init__(self, idx, axis, lookup=None):
+        self.idx = idx
+        self.name = idx.name
+        self.axis = axis
+        self.indices = self.resolve(axis, lookup=lookup)
+        self.values = idx.apply(axis)
+
+    def resolve(self, axis, lookup=None):
+        if isinstance(self.idx, Idx_arr):
+            return self.idx.index(axis, lookup=lookup)
+        else:
+            return self.idx.index(axis)
+
+    def index(self, axis, lookup=None):
+        if axis is self.axis:
+            return self.indices
+        return self.resolve(axis, lookup=lookup)
+
+    def apply(self, axis=None):
+        if axis is self.axis:
+            return self.values
+        return self.idx.apply(axis)
+
+
+class Subsetter(object):
+    '''
+    A conveniency class to use the syntax like:
+    LUT.sub()[:,:,0]
+    for subsetting LUTs
+    '''
+    def __init__(self, LUT):
+        self.LUT = LUT
+
+    def __getitem__(self, keys):
+        '''
+        subset parent LUT
+        '''
+        return self.LUT.sub(dict(enumerate(keys)))
+
+
+class LUTExpr(object):
+    '''
+    A lazy arithmetic expression of LUTs (see LUT.lazy)
+
+    The axes of the expression are determined like in the binary operations
+    between LUTs, but the broadcast results are not evaluated. Operations with
+    LUTs, expressions and scalars return new expressions, and functions
+    are applied elementwise with apply.
+
+    Arguments:
+        * lut: a LUT (leaf of the expression)
+        * fn, operands: function and operands (LUTExpr or scalars) of the
+          operation
+        * desc: description of the expression
+    '''
+    # numpy scalars defer to the operators of LUTExpr
+    __array_ufunc__ = None
+
+    def __init__(self, lut=None, fn=None, operands=None, desc=None):
+        self.lut = lut
+        self.fn = fn
+        self.operands = operands
+        if lut is not None:
+            self.names = list(lut.names)
+            self.axes = list(lut.axes)
+            self.shape = tuple(lut.shape)
+            self.attrs = lut.attrs
+            self.desc = lut.desc
+            # LUTs providing the axes of the expression
+            self.sources = dict([(a, lut) for a in lut.names])
+            return
+
+        exprs = [x for x in operands if isinstance(x, LUTExpr)]
+        self.names, self.axes, shape = [], [], []
+        self.sources = {}
+        for x in exprs:
+            for i, a in enumerate(x.names):
+                if a not in self.sources:
+                    self.sources[a] = x.sources[a]
+                elif x.shape[i] != self.shape[self.names.index(a)]:
+                    raise Exception('Axis {} has different sizes in the '
+                                    'operands ({} and {})'.format(
+                                        a, x.shape[i], self.shape[self.names.index(a)]))
+            names = interleave_seq(self.names, x.names)
+            axes, shape = [], []
+            for a in names:
+                if a in x.names:
+                    i = x.names.index(a)
+                    axes.append(x.axes[i])
+                    shape.append(x.shape[i])
+                else:
+                    i = self.names.index(a)
+                    axes.append(self.axes[i])
+                    shape.append(self.shape[i])
+            self.names, self.axes, self.shape = list(names), axes, tuple(shape)
+
+        # common attributes
+        self.attrs = {}
+        for k, v in exprs[0].attrs.items():
+            for x in exprs[1:]:
+                if k not in x.attrs:
+                    break
+                if isinstance(v, np.ndarray) or isinstance(x.attrs[k], np.ndarray):
+                    if not (isinstance(v, np.ndarray)
+                            and isinstance(x.attrs[k], np.ndarray)
+                            and np.allclose(v, x.attrs[k])):
+                        break
+                elif v != x.attrs[k]:
+                    break
+            else:
+                self.attrs[k] = v
+        self.desc = desc
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __operation__(self, other, fn, symbol, reverse=False):
+        if isinstance(other, LUT):
+            other = other.lazy()
+        operands = [other, self] if reverse else [self, other]
+        descs = [x.desc if isinstance(x, LUTExpr) else str(x) for x in operands]
+        if (descs[0] == descs[1]) and isinstance(other, LUTExpr):
+            desc = descs[0]
+        else:
+            desc = '({} {} {})'.format(descs[0], symbol, descs[1])
+        return LUTExpr(fn=fn, operands=operands, desc=desc)
+
+    def __add__(self, other):
+        return self.__operation__(other, np.add, '+')
+
+    def __radd__(self, other):
+        return self.__operation__(other, np.add, '+', reverse=True)
+
+    def __sub__(self, other):
+        return self.__operation__(other, np.subtract, '-')
+
+    def __rsub__(self, other):
+        return self.__operation__(other, np.subtract, '-', reverse=True)
+
+    def __mul__(self, other):
+        return self.__operation__(other, np.multiply, '*')
+
+    def __rmul__(self, other):
+        return self.__operation__(other, np.multiply, '*', reverse=True)
+
+    def __div__(self, other):
+        return self.__operation__(other, np.true_divide, '/')
+
+    def __rdiv__(self, other):
+        return self.__operation__(other, np.true_divide, '/', reverse=True)
+
+    def __truediv__(self, other):
+        return self.__operation__(other, np.true_divide, '/')
+
+    def __rtruediv__(self, other):
+        return self.__operation__(other, np.true_divide, '/', reverse=True)
+
+    def apply(self, fn, desc=None):
+        '''
+        returns the expression fn(self), where fn applies elementwise
+        '''
+        if desc is None:
+            desc = self.desc
+        return LUTExpr(fn=fn, operands=[self], desc=desc)
+
+    def axis_index(self, a):
+        '''
+        returns the AxisIndex of axis a (string or integer), see
+        LUT.axis_index
+        '''
+        if not isinstance(a, str):
+            a = self.names[a]
+        return self.sources[a].axis_index(a)
+
+    def evaluate(self, names, block=None, keys=None):
+        '''
+        Evaluate the expression
+            - on a grid of dimensions names (where the expression is
+              broadcastable), for the elements block (slice) of the first
+              dimension
+            - or, if keys is provided, at the integer indices keys (a
+              dictionary {axis name: int or int array})
+        '''
+        if self.lut is not None:
+            lut = self.lut
+            if keys is not None:
+                return lut[tuple([keys[a] for a in lut.names])]
+            if (block is not None) and names and (names[0] in lut.names):
+                data = lut.data[block]
+            else:
+                data = lut.data[...]
+            return np.asanyarray(data)[tuple([slice(None) if (a in lut.names) else None
+                                             for a in names])]
+
+        return self.fn(*[x.evaluate(names, block=block, keys=keys)
+                         if isinstance(x, LUTExpr) else x
+                         for x in self.operands])
+
+    def compute(self, chunk_size=None, out=None):
+        '''
+        Evaluate the expression in a single pass, and returns it as a LUT
+
+        The operations are fused over the broadcast of all the operands.
+        chunk_size: if not None, the expression is evaluated by blocks of
+            about chunk_size elements (along its first axis), so that the
+            temporary arrays are bounded by the size of the blocks
+        out: array where the result is written (default None: a new array)
+        '''
+        names = self.names
+        nrows = self.shape[0] if self.ndim else 1
+        step = nrows
+        if chunk_size is not None:
+            step = max(1, chunk_size//max(1, int(np.prod(self.shape[1:]))))
+
+        if (step >= nrows) and (out is None):
+            data = np.asanyarray(self.evaluate(names))
+            if data.shape != self.shape:
+                data = np.broadcast_to(data, self.shape).copy()
+        else:
+            for start in xrange(0, nrows, step):
+                block = slice(start, start+step)
+                res = np.asanyarray(self.evaluate(names, block=block))
+                if out is None:
+                    out = np.empty(self.shape, dtype=res.dtype)
+                if self.ndim:
+                    out[block] = res
+                else:
+                    out[...] = res
+            data = out
+
+        return LUT(data, axes=list(self.axes), names=list(self.names),
+                   attrs=dict(self.attrs), desc=self.desc)
+
+    def __getitem__(self, keys):
+        '''
+        Interpolate the expression at points (see interp)
+        '''
+        return self.interp(keys)
+
+    def interp(self, keys, operandwise=False):
+        '''
+        Interpolate the expression at points: like LUT.__getitem__, but only
+        with scalar or array keys (no slices)
+
+        The result is the multilinear interpolation of the evaluated
+        expression, without evaluating the whole expression. The operands
+        are interpolated separately on their own axes and combined, when
+        this is exact:
+            - for additions and subtractions
+            - for multiplications, if the operands have no interpolated axis
+              in common
+            - for divisions, if the divisor has no interpolated axis
+        Otherwise, the operation is evaluated at the 2^n bracketing grid
+        points of its n interpolated axes.
+
+        operandwise: if True, always interpolate the operands separately.
+            This is much faster when the operands have many interpolated
+            axes, but approximate for the other operations (for example,
+            the product of the interpolated operands instead of the
+            interpolated product).
+        '''
+        return self.interpolate(self.resolve(keys), operandwise=operandwise)
+
+    def resolve(self, keys):
+        '''
+        Returns a dictionary {axis name: index}, where the index is a
+        (float) index or array of indices, for the keys of interp
+        '''
+        if not isinstance(keys, tuple):
+            keys = (keys,)
+        if len(keys) != self.ndim:
+            raise Exception('Incorrect number of dimensions in __getitem__ '
+                            '(expecting {}, got {})'.format(self.ndim, len(keys)))
+
+        index = {}
+        for i, k in enumerate(keys):
+            name = self.names[i]
+            if isinstance(k, slice) or isinstance(k, Idx_filter):
+                raise Exception('LUTExpr.__getitem__ only supports points '
+                                '(no slices)')
+            if isinstance(k, Idx_arr):
+                if k.name not in [None, name]:
+                    msg = 'Error, wrong parameter passed at position {}, expected {}, got {}'
+                    raise Exception(msg.format(i, name, k.name))
+                k = k.index(self.axes[i], lookup=self.axis_index(i))
+            if isinstance(k, (list, tuple)):
+                k = np.array(k)
+            if is_interpolated(k) and (self.shape[i] == 1):
+                # single element
+                if isinstance(k, np.ndarray):
+                    k = np.round(k).astype('int')
+                else:
+                    k = int(round(k))
+            index[name] = k
+
+        return index
+
+    def interpolated(self, index):
+        '''
+        Returns the names of the axes of the expression interpolated with
+        index (see resolve)
+        '''
+        return [a for a in self.names if is_interpolated(index[a])]
+
+    def interpolate(self, index, operandwise=False):
+        '''
+        Interpolate the expression at index (see resolve)
+        '''
+        if self.lut is not None:
+            return self.lut[tuple([index[a] for a in self.lut.names])]
+
+        interpolated = [set(x.interpolated(index)) if isinstance(x, LUTExpr) else set()
+                        for x in self.operands]
+        if not any(interpolated):
+            separable = True
+        elif self.fn in [np.add, np.subtract]:
+            separable = True
+        elif self.fn is np.multiply:
+            separable = not (interpolated[0] & interpolated[1])
+        elif self.fn is np.true_divide:
+            separable = not interpolated[1]
+        else:
+            separable = False
+
+        if not (separable or operandwise):
+            return self.interpolate_corners(index)
+
+        return self.fn(*[x.interpolate(index, operandwise=operandwise)
+                         if isinstance(x, LUTExpr) else x
+                         for x in self.operands])
+
+    def interpolate_corners(self, index):
+        '''
+        Interpolate the expression at index (see resolve), from its values
+        at the 2^n bracketing grid points
+        '''
+        index = dict(index)
+        interpolate_axis = self.interpolated(index)
+        bounds = []    # lower and upper indices of the interpolated axes
+        weights = []   # weights of the lower and upper elements
+        for a in interpolate_axis:
+            k = index[a]
+            n = self.shape[self.names.index(a)]
+            if isinstance(k, np.ndarray):
+                inf = k.astype('int')
+                inf[inf == n-1] -= 1
+            else:
+                inf = int(k)
+                if inf == n-1:
+                    inf -= 1
+            x = k - inf
+            bounds.append((inf, inf+1))
+            weights.append((1-x, x))
+
+        # loop over the 2^n bracketing elements
+        result = 0
+        for corner in itertools.product([0, 1], repeat=len(interpolate_axis)):
+            coef = 1
+            for i, bb in enumerate(corner):
+                coef = coef * weights[i][bb]
+                index[interpolate_axis[i]] = bounds[i][bb]
+            result = result + coef*self.evaluate(self.names, keys=index)
+
+        return result
+
+
+class InterpPlan(object):
+    '''
+    Interpolation plan for repeated lookups into a LUT with the same key
+    structure
+
+    The analysis of the keys (which axes are interpolated, which are fixed, the
+    offsets of the 2^n bracketing elements) is done once when the plan is
+    built, and the plan can then be called repeatedly with new values.
+
+    Arguments:
+        * lut: the LUT to interpolate
+        * keys: key template, with the same syntax as in LUT.__getitem__
+          The positions containing an Idx (array-like values) or a float index
+          (float or float array) are variable: new values are passed for these
+          positions, in the order of the axes, each time the plan is called.
+          All other keys (int, slice, int or bool arrays, Idx filters) are
+          fixed when the plan is built.
+        * engine: interpolation engine
+            - 'fused' (default): the offsets of the bracketing elements in the
+              LUT data are calculated from the strides, all of them are
+              gathered at once and reduced in place, axis by axis
+            - 'loop': loop over the 2^n bracketing elements, with one
+              indexing of the data for each of them
+          The 'loop' engine is used for the keys or data that the 'fused'
+          engine does not support (boolean arrays, out of bounds indices...).
+          For lazy data (not a ndarray), only the hyperslab containing the
+          bracketing elements is read and interpolated.
+        * chunk_size: if not None, the arrays in the keys are processed by
+          blocks of chunk_size elements, and the results are written to a
+          preallocated output. The peak memory is then bounded by the block
+          size instead of the size of the arrays, with identical results.
+        * workers: number of threads for processing the blocks in parallel
+          (default None: no threads). Each block is written to its own part
+          of the output, so that the result does not depend on the number of
+          workers. If chunk_size is None, the arrays are split in 4 blocks
+          per worker.
+
+    Calling the plan without arguments uses the values of the template.
+
+    Example:
+    >>> P = LUT(Pdata, axes=[z, P0], names=['z', 'P0'])
+    >>> plan = InterpPlan(P, (Idx(0., 'z'), Idx(1013.)))  # or P.plan(...)
+    >>> plan(z1, P01)    # same as P[Idx(z1), Idx(P01)]
+    >>> plan(z2, P02)
+    '''
+    def __init__(self, lut, keys, engine='fused', chunk_size=None, workers=None):
+        if not isinstance(keys, tuple):
+            keys = (keys,)
+        N = len(keys)
+
+        if N != lut.ndim:
+            raise Exception('Incorrect number of dimensions in __getitem__ '
+                            '(expecting {}, got {})'.format(lut.ndim, N))
+        if engine not in ['fused', 'loop']:
+            raise ValueError('Invalid interpolation engine {}'.format(engine))
+
+        self.lut = lut
+        self.engine = engine
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.keys = list(keys)  # fixed keys
+        self.idx = N*[None]     # Idx instances for the variable Idx positions
+        self.lookups = N*[None] # AxisIndex instances for these positions
+        self.variables = []     # positions of the variable keys
+        self.defaults = []      # values of the variable keys in the template
+        self.interpolate_axis = []  # positions of the interpolated axes
+        for i, k in enumerate(keys):
+            if isinstance(k, Idx_base):
+                if k.name not in [None, lut.names[i]]:
+                    msg = 'Error, wrong parameter passed at position {}, expected {}, got {}'
+                    raise Exception(msg.format(i, lut.names[i], k.name))
+                if not isinstance(k, Idx_arr):
+                    # filters are evaluated once
+                    self.keys[i] = k.index(lut.axes[i])
+                    continue
+                self.idx[i] = k
+                self.lookups[i] = lut.axis_index(i)
+                self.variables.append(i)
+                self.defaults.append(k.value)
+                # Idx_arr.index returns integers if rounded or if the axis
+                # has a single element, floating-point indices otherwise
+                if (not k.round) and (self.lookups[i].size > 1):
+                    self.interpolate_axis.append(i)
+            elif (isinstance(k, float)
+                  or (isinstance(k, np.ndarray)
+                      and (k.dtype in [np.dtype('float32'),
+                                       np.dtype('float64')]))):
+                self.variables.append(i)
+                self.defaults.append(k)
+                self.interpolate_axis.append(i)
+
+        # the 2^n bracketing elements
+        # (cartesian product of [0, 1] over n dimensions)
+        self.corners = list(itertools.product(
+            [0, 1], repeat=len(self.interpolate_axis)))
+
+        # offsets for the fused engine
+        self.flat, self.strides = flat_view(lut.data)
+        if (engine == 'fused') and (self.flat is not None) and self.interpolate_axis:
+            # offsets of the bracketing elements relative to the lower one
+            self.corner_offsets = np.array(
+                [sum([bb*self.strides[i] for (bb, i) in zip(corner, self.interpolate_axis)])
+                 for corner in self.corners], dtype='int')
+            # offsets of the slices
+            self.slice_offsets = {}
+            for i, k in enumerate(self.keys):
+                if isinstance(k, slice):
+                    self.slice_offsets[i] = np.arange(lut.data.shape[i])[k]*self.strides[i]
+
+    def __call__(self, *values):
+        '''
+        Interpolate the LUT at values (one per variable position of the
+        template)
+
+        Returns: a scalar or ndarray
+        '''
+        if len(values) == 0:
+            values = self.defaults
+        elif len(values) != len(self.variables):
+            raise TypeError('InterpPlan expects {} values, got {}'.format(
+                len(self.variables), len(values)))
+
+        if (self.chunk_size is not None) or (self.workers is not None):
+            result = self.interpolate_chunked(values)
+            if result is not None:
+                return result
+
+        return self.evaluate(self.resolve(values))
+
+    def evaluate(self, keys, out=None):
+        '''
+        Interpolate the LUT data at keys (resolved keys), with the engine of
+        the plan
+        If out is provided, the result is written to it.
+        '''
+        if not self.interpolate_axis:
+            # no interpolation: plain indexing of the data
+            result = self.lut.data[tuple(keys)]
+            if out is not None:
+                out[...] = result
+                result = out
+            return result
+
+        if not isinstance(self.lut.data, np.ndarray):
+            # lazy data: read the hyperslab containing all the bracketing
+            # elements, and interpolate it
+            slab, keys = hyperslab(keys, self.lut.data.shape)
+            data = np.asarray(self.lut.data[tuple(slab)])
+            plan = InterpPlan(LUT(data), tuple(keys), engine=self.engine)
+            return plan.evaluate(keys, out=out)
+
+        result = None
+        if (self.engine == 'fused') and (self.flat is not None) and self.interpolate_axis:
+            result = self.interpolate_fused(keys, out=out)
+        if result is None:
+            result = self.interpolate(keys)
+            if out is not None:
+                out[...] = result
+                result = out
+
+        return result
+
+    def interpolate_chunked(self, values):
+        '''
+        Interpolate the LUT at values, by blocks of self.chunk_size elements
+        of the arrays in the keys, optionally in parallel over self.workers
+        threads
+
+        Returns None if there is no need to process by blocks.
+        '''
+        keys = list(self.keys)
+        for i, v in zip(self.variables, values):
+            if isinstance(v, (list, tuple)):
+                v = np.array(v)
+            if (self.idx[i] is not None) and (self.lookups[i].size == 1) and np.ndim(v):
+                # index is scalar, whatever the shape of v
+                return None
+            keys[i] = v
+        npre, dims_array, nslices = self.layout(keys)
+        if dims_array is None:
+            return None
+        size = int(np.prod(dims_array))
+        workers = self.workers or 1
+        chunk_size = self.chunk_size
+        if chunk_size is None:
+            chunk_size = max(1, -(-size//(4*workers)))
+        if (size <= chunk_size) or (size == 0):
+            return None
+
+        # flatten the arrays
+        for i, k in enumerate(keys):
+            if isinstance(k, np.ndarray) and (k.ndim > 0):
+                keys[i] = k.reshape(-1)
+
+        def block_keys(block):
+            bkeys = [k[block] if (isinstance(k, np.ndarray) and (k.ndim > 0)) else k
+                     for k in keys]
+            return self.resolve([bkeys[i] for i in self.variables], keys=bkeys)
+
+        blocks = [slice(start, start+chunk_size)
+                  for start in xrange(0, size, chunk_size)]
+
+        # the first block determines the output type
+        res = self.evaluate(block_keys(blocks[0]))
+        out = np.empty(res.shape[:npre] + (size,) + res.shape[npre+1:],
+                       dtype=res.dtype)
+        out[(slice(None),)*npre + (blocks[0],)] = res
+
+        def run(block):
+            self.evaluate(block_keys(block),
+                          out=out[(slice(None),)*npre + (block,)])
+
+        if workers > 1:
+            with ThreadPoolExecutor(workers) as executor:
+                # consume the results to raise the exceptions, if any
+                list(executor.map(run, blocks[1:]))
+        else:
+            for block in blocks[1:]:
+                run(block)
+
+        return out.reshape(out.shape[:npre] + dims_array + out.shape[npre+1:])
+
+    def resolve(self, values, keys=None):
+        '''
+        Returns the list of keys obtained by replacing the variable positions
+        of the template (or of keys, if provided) by the (float) indices of
+        values
+        '''
+        if keys is None:
+            keys = self.keys
+        keys = list(keys)
+        for i, v in zip(self.variables, values):
+            idx = self.idx[i]
+            if idx is not None:
+                # convert values to indices for the current axis
+                v = self.lookups[i].index(v, fill_value=idx.fill_value,
+                                          round=idx.round, name=idx.name)
+                if (i not in self.interpolate_axis) and (not isinstance(v, np.ndarray)):
+                    v = int(v)
+            elif isinstance(v, np.ndarray):
+                if v.dtype not in [np.dtype('float32'), np.dtype('float64')]:
+                    v = v.astype('float64')
+            else:
+                v = float(v)
+            keys[i] = v
 
+        return keys
 
-class Idx_arr(Idx_base):
-    '''
-    Idx class for array-like values
-    '''
-    def index(self, axis):
+    def layout(self, keys):
         '''
-        Return the floating point index of the values in the axis
+        Determine the layout of the result of the indexing by keys
+
+        Returns (npre, dims_array, nslices), where the dimensions of the
+        result are the npre first slices, then the dimensions of the arrays
+        (dims_array, None if there is no array in keys), then the remaining
+        slices
         '''
-        if len(axis) == 1:
-            if not np.allclose(np.array(self.value), axis[0]):
-                raise ValueError("(Idx) Out of axis value (value={}, axis={})".format(self.value, axis))
-            return 0
+        dims_array = None
+        for k in keys:
+            if isinstance(k, np.ndarray) and (k.ndim > 0):
+                if dims_array is None:
+                    dims_array = k.shape
+                else:
+                    assert dims_array == k.shape, 'LUTS.__getitem__: all arrays must have same shape ({} != {})'.format(str(dims_array), str(k.shape))
 
+        index = [i for i, k in enumerate(keys) if not isinstance(k, slice)]
+        nslices = len(keys) - len(index)
+        if dims_array is None:
+            return 0, None, nslices
+
+        # numpy indexing rules: the dimensions of the index arrays replace
+        # the indexed dimensions if they are all next to each other,
+        # otherwise they come first
+        if index == list(xrange(index[0], index[-1]+1)):
+            npre = index[0]
         else:
-            # axis is scalar or ndarray: interpolate
-            if self.fill_value == 'extrema':
-                fv = (0, len(axis)-1)
-            elif self.fill_value == 'extrema,warn':
-                fv = (0, len(axis)-1)
-                if (np.amax(self.value) > np.amax(axis)):
-                    warnings.warn('(Idx) Value {} is above the axis maximum {} (axis {})'.format(
-                        np.amax(self.value), np.amax(axis), self.name))
-                if (np.amin(self.value) < np.amin(axis)):
-                    warnings.warn('(Idx) Value {} is under the axis minimum {} (axis {})'.format(
-                        np.amin(self.value), np.amin(axis), self.name))
+            npre = 0
+
+        return npre, dims_array, nslices
+
+    def interpolate(self, keys):
+        '''
+        Multi-linear interpolation of the LUT data at keys (resolved keys,
+        where all Idx have been converted to indices), looping over the 2^n
+        bracketing elements
+        '''
+        data = self.lut.data
+        keys = list(keys)
+        npre, dims_array, nslices = self.layout(keys)
+        if dims_array is not None:
+            # shape of the result, with singleton dimensions for the slices
+            shp_res = (1,)*npre + dims_array + (1,)*(nslices-npre)
+
+        # for the interpolated axes, determine the lower index (inf) and the
+        # weight (x) between lower and upper index
+        bounds = []     # lower and upper indices
+        weights = []    # weights of the lower and upper elements
+        for i in self.interpolate_axis:
+            k = keys[i]
+            if isinstance(k, np.ndarray):
+                inf = k.astype('int')
+                inf[inf == data.shape[i]-1] -= 1
+                x = k-inf
+                if k.ndim > 0:
+                    x = x.reshape(shp_res)
             else:
-                fv = self.fill_value
-            be = (self.fill_value is None)
-
-            res = interp1d(axis, np.arange(len(axis)),
-                    bounds_error=be,
-                    fill_value=fv)(self.value)
-            if self.round:
-                if isinstance(res, np.ndarray):
-                    res = res.round().astype(int)
-                else:
-                    res = round(res)
-            return res
+                inf = int(k)
+                if inf == data.shape[i]-1:
+                    inf -= 1
+                x = k-inf
+            bounds.append((inf, inf+1))
+            weights.append((1-x, x))
 
+        # loop over the 2^n bracketing elements
+        result = 0
+        for corner in self.corners:
 
-    def apply(self, axis=None):
-        return self.value
+            # coefficient attributed to the current item
+            # and adjust the indices
+            # for the interpolated dimensions
+            coef = 1
+            for i, bb in enumerate(corner):
+                coef = coef * weights[i][bb]
+                keys[self.interpolate_axis[i]] = bounds[i][bb]
 
-class Idx_filter(Idx_base):
-    '''
-    Idx class for filtering functions
-    '''
-    def index(self, axis):
-        # value is a callable (function):
-        # returns value applied to axis
-        return self.value(axis)
+            result += coef * data[tuple(keys)]
 
-    def apply(self, axis):
-        return axis[self.index(axis)]
+        return result
 
+    def evaluate_many(self, datas, values=None):
+        '''
+        Interpolate several arrays with the shape of the LUT data (for
+        example the datasets of a MLUT with the same axes) at values (see
+        __call__, default: the values of the template)
 
-class Subsetter(object):
-    '''
-    A conveniency class to use the syntax like:
-    LUT.sub()[:,:,0]
-    for subsetting LUTs
-    '''
-    def __init__(self, LUT):
-        self.LUT = LUT
+        The keys are resolved once, and with the fused engine, the offsets
+        and weights of the bracketing elements are calculated once for all
+        the arrays with the same memory layout as the LUT data.
 
-    def __getitem__(self, keys):
+        Returns the list of results
         '''
-        subset parent LUT
+        if values is None:
+            values = self.defaults
+        keys = self.resolve(values)
+
+        prepared = None
+        if (self.engine == 'fused') and (self.flat is not None) and self.interpolate_axis:
+            prepared = self.prepare_fused(keys)
+
+        results = []
+        for data in datas:
+            flat, strides = flat_view(data)
+            if (data is self.lut.data) or (data.dtype.char in ['S', 'U']):
+                results.append(self.evaluate(keys) if (data is self.lut.data)
+                               else data[tuple(keys)])
+            elif (prepared is not None) and (flat is not None) and (strides == self.strides):
+                results.append(self.gather_fused(flat, prepared))
+            else:
+                plan = InterpPlan(LUT(data), tuple(keys), engine=self.engine)
+                results.append(plan.evaluate(keys))
+
+        return results
+
+    def interpolate_fused(self, keys, out=None):
         '''
-        return self.LUT.sub(dict(enumerate(keys)))
+        Multi-linear interpolation of the LUT data at keys (resolved keys),
+        using a single gather of all the bracketing elements
+        If out is provided, the result is written to it.
+
+        Returns None if the keys are not supported by this engine.
+        '''
+        prepared = self.prepare_fused(keys)
+        if prepared is None:
+            return None
+        return self.gather_fused(self.flat, prepared, out=out)
+
+    def prepare_fused(self, keys):
+        '''
+        Returns the offsets of the lower bracketing elements in the flat LUT
+        data, and the weights of the interpolated axes, for the fused engine
+        at keys (resolved keys), or None if the keys are not supported by
+        this engine.
+        If the last key is a full slice of the innermost contiguous axis
+        (vector-valued LUT, see LUT.vector), the offsets are those of the
+        vectors, which are gathered as rows.
+        '''
+        shape = self.lut.data.shape
+        npre, dims_array, nslices = self.layout(keys)
+        if dims_array is None:
+            dims_array = ()
+        ndim = nslices + len(dims_array)  # dimensions of the result
+
+        def expand(a, dim):
+            # reshape a to the result dimensions, starting at dim
+            if isinstance(a, np.ndarray) and (a.ndim > 0):
+                return a.reshape((1,)*dim + a.shape + (1,)*(ndim-dim-a.ndim))
+            return a
+
+        # offsets of the lower bracketing element, and weights
+        offsets = 0
+        weights = []
+        islice = 0
+        vector = 0      # size of the vectors gathered as rows
+        for i, k in enumerate(keys):
+            n = shape[i]
+            if (isinstance(k, slice) and (i == len(keys)-1) and (n > 1)
+                    and (self.strides[i] == 1) and (k.indices(n) == (0, n, 1))
+                    and (self.flat.size % n == 0)
+                    and not [st for st in self.strides[:-1] if st % n]):
+                vector = n
+            elif isinstance(k, slice):
+                dim = islice if (islice < npre) else (islice + len(dims_array))
+                offsets = offsets + expand(self.slice_offsets[i], dim)
+                islice += 1
+            elif i in self.interpolate_axis:
+                if isinstance(k, np.ndarray):
+                    inf = k.astype('int')
+                    inf[inf == n-1] -= 1
+                    if (inf.size == 0) or (inf.min() < 0) or (inf.max() > n-2):
+                        return None
+                else:
+                    inf = int(k)
+                    if inf == n-1:
+                        inf -= 1
+                    if (inf < 0) or (inf > n-2):
+                        return None
+                weights.append(expand(k - inf, npre))
+                offsets = offsets + expand(inf*self.strides[i], npre)
+            elif isinstance(k, (int, np.integer)) and not isinstance(k, bool):
+                if (k < -n) or (k >= n):
+                    return None
+                offsets = offsets + (k % n)*self.strides[i]
+            elif isinstance(k, np.ndarray) and (k.dtype.kind in ['i', 'u']):
+                if (k.size == 0) or (k.min() < -n) or (k.max() >= n):
+                    return None
+                offsets = offsets + expand((k % n)*self.strides[i], npre)
+            else:
+                return None
+
+        return offsets, weights, ndim, vector
 
+    def gather_fused(self, flat, prepared, out=None):
+        '''
+        Gather and reduce the bracketing elements of flat (flat view of the
+        LUT data, or of an array with the same layout), with the offsets and
+        weights of prepare_fused
+        If out is provided, the result is written to it.
+        '''
+        offsets, weights, ndim, vector = prepared
+        dtype = np.result_type(flat.dtype, *weights)
+        index = self.corner_offsets.reshape((-1,) + (1,)*ndim) + offsets
+
+        if not vector:
+            # gather all the bracketing elements at once, along a first
+            # "corners" dimension
+            values = flat.take(index).astype(dtype, copy=False)
+            if out is None:
+                out = np.empty(values.shape[1:], dtype=dtype)
+            result = reduce_corners(values, weights, out)
+            if result.ndim == 0:
+                return result[()]
+            return result
+
+        # vector-valued LUT: gather the rows of vector contiguous elements,
+        # by blocks of points to keep the bracketing elements in cache
+        shape = np.broadcast(index[0], *weights).shape[:-1]
+        npts = int(np.prod(shape))
+        index = np.broadcast_to(index[..., 0], (len(index),) + shape).reshape(len(index), npts)
+        weights = [np.broadcast_to(x, shape + (1,)).reshape(npts, 1) for x in weights]
+        rows = flat.reshape((-1, vector))
+        if (out is None) or (not out.flags.c_contiguous):
+            result = np.empty((npts, vector), dtype=dtype)
+        else:
+            result = out.reshape((npts, vector))
+        block = max(1, 2**16//(len(index)*vector))
+        for start in xrange(0, npts, block):
+            b = slice(start, start+block)
+            values = rows.take(index[:, b]//vector, axis=0).astype(dtype, copy=False)
+            reduce_corners(values, [x[b] for x in weights], result[b])
+
+        result = result.reshape(shape + (vector,))
+        if out is not None:
+            out[...] = result
+            result = out
+        return result
 
 def plot_polar(lut, index=None, vmin=None, vmax=None, rect=211, sub=212,
                sym=True, swap='auto', fig=None, cmap=None, semi=False):
@@ -1466,17 +3036,41 @@ def transect2D(lut, index=None, vmin=None, vmax=None, sym=True, swap='auto', fig
         ax_cart.set_title(lut.desc)
 
 
-def merge(M, axes, dtype=None):
+def merge(M, axes, dtype=None, axis_values=None, filename=None, sort=False,
+          fmt=None):
     '''
     Merge several luts
 
     Arguments:
-        - M is a list of MLUT objects to merge
+        - M is an iterable of MLUT objects to merge, or of filenames (read
+          with read_mlut). The MLUTs are processed one at a time, so that
+          only one of the files is loaded at once.
         - axes is a list of axes names to merge
           these names should be present in each LUT attribute
         - dtype is the data type of the new axes
           ex: dtype=float
           if None, no data type conversion
+        - axis_values: dictionary {axis_name: values} of the new axes
+          if None (default), the new axes are determined by a first pass over
+          the attributes of M (only the attributes are read from the files,
+          and an iterator of filenames is first converted to a list)
+          otherwise M is iterated only once (M can be a generator of MLUT
+          objects, which requires axis_values)
+        - filename: if provided, the merged MLUT is written to this file as
+          it is filled, one MLUT at a time, instead of being allocated in
+          memory
+        - sort: if True, sort the values of the new axes
+          default False: the values are in order of appearance
+        - fmt: format of filename
+            * 'mmap': the merged MLUT is returned memory-mapped (see
+              read_mlut_mmap)
+            * 'netcdf4' or 'hdf5': the datasets are chunked by slabs of
+              one element along the new axes (each MLUT is written to one
+              chunk), and the merged MLUT is returned with lazy datasets
+              (see read_mlut_netcdf4 and read_mlut_hdf5), to be closed with
+              MLUT.close
+            * None (default): determined from the extension of filename
+              (.nc: netcdf4, .h5 or .hdf5: hdf5, otherwise mmap)
 
     Returns a MLUT for which each dataset has new axes as defined in list axes
     (list of strings)
@@ -1507,78 +3101,264 @@ def merge(M, axes, dtype=None):
       [2] c: 4 values between 0 and 30
 
     '''
+    def convert(value):
+        if dtype is not None:
+            return dtype(value)
+        return value
+
+    # determine the new axes
+    if axis_values is None:
+        # from the attributes of all mluts
+        if iter(M) is M:
+            # an iterator of filenames can be converted to a list, not an
+            # iterator of MLUTs, which would all be loaded at once
+            M = list(itertools.chain([next(M, None)], M))
+            if isinstance(M[0], MLUT):
+                raise Exception('merge: axis_values should be provided to '
+                                'merge an iterator of MLUT objects')
+            if M[0] is None:
+                M = []
+        newaxes = merge_axes(M, axes, dtype=dtype, sort=sort)
+    else:
+        newaxes = [[convert(v) for v in axis_values[axname]] for axname in axes]
+        if sort:
+            newaxes = [sorted(axis) for axis in newaxes]
 
-    m = MLUT()
-    first = M[0]
+    # index of each value in the new axes
+    positions = [axis_positions(axis) for axis in newaxes]
+
+    if filename is not None:
+        if exists(filename):
+            raise Exception('File {} exists'.format(filename))
+        if fmt is None:
+            if filename.endswith('.nc'):
+                fmt = 'netcdf4'
+            elif filename.endswith('.h5') or filename.endswith('.hdf5'):
+                fmt = 'hdf5'
+            else:
+                fmt = 'mmap'
+
+    ref = None
+    for mlut in M:
+        if not isinstance(mlut, MLUT):
+            mlut = read_mlut(mlut)
+
+        if ref is None:
+            # structure of the first mlut, without its data
+            ref = MLUT()
+            for (axname, axis) in mlut.axes.items():
+                ref.add_axis(axname, axis)
+            for (name, data, axnames, _) in mlut.data:
+                ref.add_dataset(name, np.broadcast_to(np.zeros((), dtype=data.dtype),
+                                                      data.shape), axnames)
+            common = OrderedDict(mlut.attrs)
+            fingerprint = mlut.fingerprint()
+
+            # allocate the new data
+            datasets = [(name, tuple(map(len, newaxes))+data.shape, data.dtype,
+                         list(axes)+list(axnames), {})
+                        for (name, data, axnames, _) in ref.data]
+            allaxes = list(ref.axes.items()) + list(zip(axes, newaxes))
+            if filename is None:
+                arrays = [np.zeros(shape, dtype=_dtype)
+                          for (_, shape, _dtype, _, _) in datasets]
+            elif fmt == 'mmap':
+                arrays = init_mmap(filename, allaxes, datasets, common)
+            else:
+                target, arrays = init_chunked(filename, fmt, allaxes,
+                                              datasets, len(axes))
+
+            # elements of the new axes which have been written
+            written = np.zeros(tuple(map(len, newaxes)), dtype='bool')
+        else:
+            # check mluts compatibility (the detailed check is done only if
+            # the fingerprints differ)
+            if mlut.fingerprint() != fingerprint:
+                assert ref.equal(mlut, content=False, attributes=False, show_diff=True)
+
+            # keep the common attributes with identical values
+            for k, v in list(common.items()):
+                if k not in mlut.attrs:
+                    common.pop(k)
+                elif isinstance(v, np.ndarray):
+                    if not np.allclose(v, mlut.attrs[k]):
+                        common.pop(k)
+                elif not (v == mlut.attrs[k]):
+                    common.pop(k)
+
+        # find the index of the attributes in the new LUT
+        index = ()
+        for j, a in enumerate(axes):
+            value = convert(mlut.attrs[a])
+            try:
+                index += (positions[j][value],)
+            except (KeyError, TypeError):
+                # not found, or not hashable
+                index += (newaxes[j].index(value),)
 
-    # check mluts compatibility
-    for i in xrange(1, len(M)):
-        assert first.equal(M[i], content=False, attributes=False, show_diff=True)
+        for name, newdata in zip(ref.datasets(), arrays):
+            if isinstance(newdata, np.ndarray):
+                newdata[index] = mlut[name].data
+            else:
+                with FILE_LOCK:
+                    newdata[index] = mlut[name].data
+        written[index] = True
+
+    if ref is None:
+        raise Exception('No MLUT to merge')
+
+    # the missing elements are NaN (floating point datasets) or zero
+    for newdata in arrays:
+        fill = np.nan if (newdata.dtype.kind in ['f', 'c']) else 0
+        if isinstance(newdata, np.ndarray):
+            # initialized to zero
+            if fill != 0:
+                newdata[~written] = fill
+        else:
+            for index in np.argwhere(~written):
+                with FILE_LOCK:
+                    newdata[tuple(index)] = fill
+
+    if (filename is not None) and (fmt == 'mmap'):
+        for newdata in arrays:
+            if isinstance(newdata, np.memmap):
+                newdata.flush()
+        del arrays
+        set_mmap_attrs(filename, common)
+        return read_mlut_mmap(filename)
+    elif filename is not None:
+        with FILE_LOCK:
+            if fmt == 'netcdf4':
+                target.setncatts(common)
+            else:
+                target.attrs.update(common)
+            target.close()
+        del arrays
+        if fmt == 'netcdf4':
+            return read_mlut_netcdf4(filename, lazy=True)
+        else:
+            return read_mlut_hdf5(filename, lazy=True)
 
-    # add old axes
-    for (axname, axis) in first.axes.items():
+    m = MLUT()
+
+    # add old and new axes
+    for (axname, axis) in ref.axes.items():
         m.add_axis(axname, axis)
+    for axname, axis in zip(axes, newaxes):
+        m.add_axis(axname, axis)
+
+    for (name, _, _, axnames, _), newdata in zip(datasets, arrays):
+        m.add_dataset(name, newdata, axnames)
 
-    # determine the new axes from the attributes of all mluts
-    newaxes = []  # new axes
-    newaxnames = []
-    for axname in axes:
-        axis = []
-        for mlut in M:
-            value = mlut.attrs[axname]
+    # fill with common arguments
+    for k, v in common.items():
+        m.set_attr(k, v)
+
+    return m
+
+
+def merge_axes(M, axes, dtype=None, sort=False):
+    '''
+    Determine the new axes of the merge of M (see merge) from the attributes
+    of each MLUT or file (only the attributes are read from the files)
+
+    Returns a list of lists of values (one for each axis in axes)
+    '''
+    newaxes = [[] for _ in axes]
+    positions = [{} for _ in axes]  # values already in newaxes
+    for mlut in M:
+        if isinstance(mlut, MLUT):
+            attrs = mlut.attrs
+        else:
+            attrs = read_mlut(mlut, datasets=[]).attrs
+        for j, axname in enumerate(axes):
+            value = attrs[axname]
             if dtype is not None:
                 value = dtype(value)
-            if value not in axis:
-                axis.append(value)
-        m.add_axis(axname, axis)
-        newaxes.append(axis)
-        newaxnames.append(axname)
+            try:
+                if value not in positions[j]:
+                    positions[j][value] = len(newaxes[j])
+                    newaxes[j].append(value)
+            except TypeError:
+                # not hashable
+                if value not in newaxes[j]:
+                    newaxes[j].append(value)
 
-    # dataset loop
-    for name in first.datasets():
+    if sort:
+        newaxes = [sorted(axis) for axis in newaxes]
 
-        # build new data
-        new_shape = tuple(map(len, newaxes))+first[name].shape
-        _dtype = first[name].data.dtype
-        newdata = np.zeros(new_shape, dtype=_dtype)
-        try:
-            newdata += np.nan
-        except:
-            pass
-        for mlut in M:
-
-            # find the index of the attributes in the new LUT
-            index = ()
-            for j, a in enumerate(axes):
-                value = mlut.attrs[a]
-                if dtype is not None:
-                    value = dtype(value)
-                index += (newaxes[j].index(value),)
+    return newaxes
 
-            if first[name].data.ndim != 0:
-                index += (slice(None),)
 
-            newdata[index] = mlut[name].data
+def axis_positions(axis):
+    '''
+    Returns a dictionary {value: index} of the (hashable) values of axis
+    If a value is present several times, its first index is used, like
+    list.index.
+    '''
+    positions = {}
+    for i, value in enumerate(axis):
+        try:
+            positions.setdefault(value, i)
+        except TypeError:
+            pass
+    return positions
 
-        axnames = first[name].names
-        if axnames is None:
-            m.add_dataset(name, newdata)
-        else:
-            m.add_dataset(name, newdata, newaxnames+axnames)
 
-    # fill with common arguments
-    for k, v in first.attrs.items():
-        if False in map(lambda x: k in x.attrs, M):
-            continue
-        if isinstance(v, np.ndarray):
-            if False in map(lambda x: np.allclose(v, x.attrs[k]), M):
-                continue
-        else:
-            if False in map(lambda x: v == x.attrs[k], M):
-                continue
-        m.set_attr(k, v)
+def merge_files(filenames, axes, dtype=None, workers=None, target=None,
+                executor='process', sort=False):
+    '''
+    Merge the MLUTs stored in several files (see merge), reading them in
+    parallel
 
-    return m
+    Arguments:
+        - filenames: list of files to merge (read with read_mlut)
+        - axes, dtype, sort: see merge
+        - workers: number of workers reading the files (default None: number
+          of processors)
+        - target: if provided, the merged MLUT is written to this file (in
+          mmap, netcdf4 or hdf5 format, depending on its extension) and
+          returned memory-mapped or lazy (see merge)
+        - executor: 'process' (default) or 'thread': read the files in a pool
+          of processes or of threads
+
+    The attributes of the files (which determine the new axes) are read in
+    the pool, then the files are read concurrently, and each MLUT is copied to its place in
+    the merged MLUT as soon as it is available. At most 2*workers MLUTs are
+    being read or waiting to be merged at any time.
+    '''
+    filenames = list(filenames)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if executor == 'process':
+        # processes are spawned rather than forked, because forking a
+        # process using the hdf5/netcdf libraries is not safe
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    elif executor == 'thread':
+        pool = ThreadPoolExecutor(workers)
+    else:
+        raise ValueError('Invalid executor {}'.format(executor))
+
+    def read_all():
+        # submit the files progressively, yield the MLUTs as they are read
+        remaining = iter(filenames)
+        pending = set([pool.submit(read_mlut, f)
+                       for f in itertools.islice(remaining, 2*workers)])
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.update([pool.submit(read_mlut, f)
+                                for f in itertools.islice(remaining, 1)])
+                yield future.result()
+
+    with pool:
+        # new axes, from the attributes of the files (read in the pool)
+        attrs = pool.map(functools.partial(read_mlut, datasets=[]), filenames,
+                         chunksize=max(1, len(filenames)//(4*workers)))
+        newaxes = merge_axes(attrs, axes, dtype=dtype, sort=sort)
+
+        return merge(read_all(), axes, dtype=dtype,
+                     axis_values=dict(zip(axes, newaxes)), filename=target)
 
 
 class MLUT(object):
@@ -1618,14 +3398,56 @@ class MLUT(object):
     def __init__(self):
         # axes
         self.axes = OrderedDict()
-        # data: a list of (name, array, axnames, attributes)
-        self.data = []
+        # datasets: an ordered dictionary name -> (name, array, axnames, attributes)
+        self.entries = OrderedDict()
+        # cache of the LUTs returned by __getitem__, by dataset name
+        self.views = {}
         # attributes
         self.attrs = OrderedDict()
+        # cache of AxisIndex, shared with the LUTs (see LUT.axis_index)
+        self.axis_cache = AxisCache(self)
+        # files kept open for lazy reading (see close)
+        self.files = []
+
+    @property
+    def data(self):
+        '''
+        list of the datasets, as (name, array, axnames, attributes)
+        This is a new list: data should be assigned to modify the datasets.
+        '''
+        return list(self.entries.values())
+
+    @data.setter
+    def data(self, data):
+        self.entries = OrderedDict([(x[0], tuple(x)) for x in data])
+        self.views = {}
+
+    def load(self):
+        '''
+        Read the lazy datasets (not ndarrays) into memory
+        '''
+        self.data = [(name, data if isinstance(data, np.ndarray) else np.asarray(data),
+                      axnames, attrs)
+                     for (name, data, axnames, attrs) in self.data]
+
+    def close(self):
+        '''
+        Close the files kept open for lazy reading
+        '''
+        with FILE_LOCK:
+            for f in self.files:
+                f.close()
+        self.files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def datasets(self):
         ''' returns a list of the datasets names '''
-        return [x[0] for x in self.data]
+        return list(self.entries)
 
     def add_axis(self, name, axis):
         ''' Add an axis to the MLUT '''
@@ -1638,6 +3460,7 @@ class MLUT(object):
         assert ax.ndim == 1
 
         self.axes[name] = ax
+        self.views = {}
 
     def add_dataset(self, name, dataset, axnames=None, attrs={}):
         '''
@@ -1647,7 +3470,7 @@ class MLUT(object):
         axnames: list of (strings or None), or None
         attrs: dataset attributes
         '''
-        assert name not in [x[0] for x in self.data], 'Error, "{}" already in MLUT'.format(name)
+        assert name not in self.entries, 'Error, "{}" already in MLUT'.format(name)
         if axnames is not None:
             # check axes consistency
             assert len(axnames) == len(dataset.shape)
@@ -1658,7 +3481,7 @@ class MLUT(object):
         else:
             axnames = [None]*dataset.ndim
 
-        self.data.append((name, dataset, axnames, attrs))
+        self.entries[name] = (name, dataset, axnames, attrs)
 
     def add_lut(self, lut, desc=None):
         '''
@@ -1673,8 +3496,8 @@ class MLUT(object):
             axname = lut.names[iax]
             ax = lut.axes[iax]
             if axname in self.axes:
-                # check axis
-                if ax is not None:
+                # check axis (unless it is the same object)
+                if (ax is not None) and (ax is not self.axes[axname]):
                     assert np.array(self.axes[axname]).shape == np.array(ax).shape, \
                             'Inconsistent shapes for axis "{}": {} != {}'.format(
                                     axname, self.axes[axname].shape, ax.shape)
@@ -1693,37 +3516,150 @@ class MLUT(object):
         ''' remove a LUT '''
         assert isinstance(name, (str, bytes))
 
-        try:
-            index = [x[0] for x in self.data].index(name)
-        except ValueError:
-            raise Exception('{} is not in {}', name, self)
+        if name not in self.entries:
+            raise Exception('{} is not in {}'.format(name, self))
 
-        self.data.pop(index)
+        self.entries.pop(name)
+        self.views.pop(name, None)
 
-    def sub(self, d):
+    def sub(self, d, copy=False):
         '''
         The MLUT equivalent of LUT.sub
 
         returns a MLUT where each LUT is subsetted using dictionary d
         keys should only be strings
         values can be int, float, slice, Idx, array (bool or int)
+        copy: whether to copy the data of the subsets (see LUT.sub)
         '''
         m = MLUT()
         for dd in d:
             assert isinstance(dd, str)
 
-        for dd in self.datasets():
-            m.add_lut(self[dd].sub(d, ignore=True))
+        # each Idx is resolved once per axis, for all the datasets
+        d = dict(d)
+        for ax, v in d.items():
+            if isinstance(v, Idx_base) and (ax in self.axes):
+                lookup = self.axis_cache.index(self.axes[ax], list(self.axes.values()))
+                d[ax] = Idx_resolved(v, self.axes[ax], lookup=lookup)
+
+        # the datasets with the same axes are subsetted together: the keys,
+        # and the interpolation indices and weights are calculated once
+        groups = OrderedDict()
+        for name, data, axnames, _ in self.data:
+            key = (None if axnames is None else tuple(axnames), data.shape)
+            groups.setdefault(key, []).append(name)
+        subs = {}
+        for names in groups.values():
+            luts = [self[name] for name in names]
+            if luts[0].ndim == 0:
+                # scalar datasets are not subsetted
+                subs.update(zip(names, luts))
+                continue
+            keys, axes, axnames = luts[0].sub_keys(d, ignore=True)
+            datas = InterpPlan(luts[0], tuple(keys)).evaluate_many(
+                [lut.data for lut in luts])
+            for name, lut, data in zip(names, luts, datas):
+                subs[name] = lut.sub_lut(data, axes, axnames, copy=copy)
+
+        for name in self.datasets():
+            m.add_lut(subs[name])
 
         m.attrs = self.attrs
 
         return m
 
+    def interp(self, points, datasets=None):
+        '''
+        Interpolate several datasets at the same points
+
+        points: dictionary {axis_name: values}, where values are the
+            coordinates in this axis (scalar or array), or an Idx (for its
+            options, like fill_value). The arrays should have the same
+            shape. The axes of the datasets which are not in points are
+            kept entirely (like a slice).
+        datasets: list of the names of the datasets to interpolate
+            (default None: all datasets)
+
+        The indices of the values are calculated once per axis, and the
+        datasets with the same axes are interpolated together, with the
+        interpolation weights calculated once (see InterpPlan.evaluate_many).
+
+        Returns a dictionary {dataset name: interpolated values}
+
+        Example:
+        >>> res = m.interp({'wav': wav, 'thv': thv}, datasets=['Rtoa', 'Tdown'])
+        >>> res['Rtoa']     # same as m['Rtoa'][Idx(wav), Idx(thv)]
+        '''
+        if datasets is None:
+            datasets = self.datasets()
+
+        # indices in each axis
+        index = {}
+        for ax, v in points.items():
+            if ax not in self.axes:
+                raise Exception('Axis {} is not in {}'.format(ax, self))
+            if not isinstance(v, Idx_arr):
+                v = Idx(v)
+            lookup = self.axis_cache.index(self.axes[ax], list(self.axes.values()))
+            index[ax] = v.index(self.axes[ax], lookup=lookup)
+
+        # the datasets with the same axes are interpolated together
+        groups = OrderedDict()
+        for name in datasets:
+            _, data, axnames, _ = self.entries[name]
+            groups.setdefault((tuple(axnames), data.shape), []).append(name)
+        results = {}
+        for (axnames, _), names in groups.items():
+            luts = [self[name] for name in names]
+            keys = tuple([index[a] if (a in index) else slice(None)
+                          for a in axnames])
+            datas = InterpPlan(luts[0], keys).evaluate_many([lut.data for lut in luts])
+            results.update(zip(names, datas))
+
+        return OrderedDict([(name, results[name]) for name in datasets])
+
+    def vector(self, datasets=None, name='dataset'):
+        '''
+        Stack several datasets with the same axes in a vector-valued LUT,
+        whose last dimension (name) is the dataset, contiguous in memory
+
+        datasets: list of the names of the datasets (default None: all
+            datasets)
+        The names of the datasets are stored in the attribute 'datasets' of
+        the LUT.
+
+        Interpolating this LUT with a slice on the last axis gathers all the
+        datasets at once (see LUT.vector).
+
+        Example:
+        >>> V = m.vector(['Rtoa', 'Tdown'])
+        >>> V[Idx(wav), Idx(thv), :]     # shape wav.shape + (2,)
+        '''
+        if datasets is None:
+            datasets = self.datasets()
+        luts = [self[d] for d in datasets]
+        for lut in luts[1:]:
+            if (lut.names != luts[0].names) or (lut.shape != luts[0].shape):
+                raise Exception('Cannot stack datasets {} and {} with different axes'.format(
+                    luts[0].desc, lut.desc))
+
+        data = np.empty(luts[0].shape + (len(luts),),
+                        dtype=np.result_type(*[lut.data.dtype for lut in luts]))
+        for i, lut in enumerate(luts):
+            data[..., i] = lut.data
+        attrs = OrderedDict(self.attrs)
+        attrs['datasets'] = list(datasets)
+
+        return luts[0].new(data, list(luts[0].axes) + [None],
+                           list(luts[0].names) + [name],
+                           attrs, None, axis_cache=self.axis_cache)
+
     def save(self, filename, fmt=None, overwrite=False,
              verbose=False, compress=True):
         '''
         Save a MLUT to filename
-        fmt: output format: hdf4, netcdf4,
+        fmt: output format: hdf4, netcdf4, mmap (uncompressed, can be
+             memory-mapped by read_mlut)
              or None (determine from filename extension)
         '''
 
@@ -1743,16 +3679,22 @@ class MLUT(object):
                 fmt = 'hdf4'
             elif filename.endswith('.nc'):
                 fmt = 'netcdf4'
+            elif filename.endswith('.mlut'):
+                fmt = 'mmap'
             else:
                 raise ValueError('Cannot determine desired format '
                         'of filename "{}"'.format(filename))
 
         if fmt=='netcdf4':
-            self.__save_netcdf4(filename, overwrite=overwrite,
-                              verbose=verbose, compress=compress)
+            with FILE_LOCK:
+                self.__save_netcdf4(filename, overwrite=overwrite,
+                                    verbose=verbose, compress=compress)
         elif fmt=='hdf4':
-            self.__save_hdf(filename, overwrite=overwrite,
-                          verbose=verbose, compress=compress)
+            with FILE_LOCK:
+                self.__save_hdf(filename, overwrite=overwrite,
+                                verbose=verbose, compress=compress)
+        elif fmt=='mmap':
+            self.__save_mmap(filename, verbose=verbose)
         else:
             raise ValueError('Invalid format {}'.format(fmt))
 
@@ -1794,6 +3736,25 @@ class MLUT(object):
         root.close()
 
 
+    def __save_mmap(self, filename, verbose=False):
+        '''
+        Save a MLUT in the memory-mappable format (see read_mlut_mmap)
+        '''
+        for name, data, _, _ in self.data:
+            if data.dtype.hasobject:
+                raise ValueError('Cannot save dataset {} with dtype {} '
+                                 'in mmap format'.format(name, data.dtype))
+        arrays = init_mmap(filename, list(self.axes.items()),
+                           [(name, data.shape, data.dtype, axnames, attrs)
+                            for (name, data, axnames, attrs) in self.data],
+                           self.attrs)
+        for (name, data, _, _), arr in zip(self.data, arrays):
+            if verbose:
+                print('   Write data "{}" ({}, {})'.format(name, data.dtype, data.shape))
+            arr[...] = data[...]
+            if isinstance(arr, np.memmap):
+                arr.flush()
+
     def __save_hdf(self, filename, overwrite=False, verbose=False, compress=True):
         '''
         Save a MLUT to a hdf file
@@ -1982,19 +3943,24 @@ class MLUT(object):
         return the LUT corresponding to key (int or string)
         '''
         if isinstance(key, (str, unicode)):
-            index = -1
-            for i, (name, _, _, _) in enumerate(self.data):
-                if key == name:
-                    index = i
-                    break
-            if index == -1:
+            if key not in self.entries:
                 raise Exception('Cannot find dataset {}'.format(key))
+            name, dataset, axnames, attrs = self.entries[key]
         elif isinstance(key, int):
-            index = key
+            name, dataset, axnames, attrs = self.data[key]
         else:
             raise Exception('multi-dimensional LUTs should only be indexed with strings or integers')
 
-        name, dataset, axnames, attrs = self.data[index]
+        # the cached LUT is not reused if it has been modified, or if the
+        # axes of the MLUT have been replaced
+        lut = self.views.get(name)
+        if ((lut is not None) and (lut.data is dataset)
+                and (lut.names is axnames) and (lut.desc is name)
+                and (lut.attrs is attrs)
+                and ((axnames is None)
+                     or all([a is self.axes.get(n) for (a, n) in zip(lut.axes, axnames)]))):
+            return lut
+
         if axnames is None:
             axes = None
         else:
@@ -2005,7 +3971,11 @@ class MLUT(object):
                 else:
                     axes.append(self.axes[ax])
 
-        return LUT(desc=name, data=dataset, axes=axes, names=axnames, attrs=attrs)
+        lut = LUT(desc=name, data=dataset, axes=axes, names=axnames, attrs=attrs)
+        lut.axis_cache = self.axis_cache
+        self.views[name] = lut
+
+        return lut
 
     def equal(self, other, content=True, attributes=True, show_diff=False):
         '''
@@ -2069,6 +4039,27 @@ class MLUT(object):
     def __neq__(self, other):
         return not self.equal(other)
 
+    def fingerprint(self):
+        '''
+        Returns a structural fingerprint of the MLUT (hashable): names and
+        values of the axes, names, shapes and axes of the datasets
+
+        Two MLUTs with the same fingerprint are equal with content=False and
+        attributes=False (see equal). Axes containing NaNs are never equal,
+        so they are identified by the MLUT instance.
+        '''
+        axes = []
+        for (name, ax) in self.axes.items():
+            ax = np.asarray(ax)
+            if (ax.dtype.kind in ['f', 'c']) and np.isnan(ax).any():
+                axes.append((name, id(self)))
+            else:
+                axes.append((name, ax.dtype.str, ax.tobytes()))
+        axes = tuple(axes)
+        datasets = tuple([(name, tuple(data.shape), tuple(axnames))
+                          for (name, data, axnames, _) in self.data])
+        return (axes, datasets)
+
     def axis(self, axname, aslut=False):
         '''
         returns an axis
@@ -2220,6 +4211,7 @@ class MLUT(object):
         '''
         # modify axes
         self.axes = OrderedDict(((ax2 if k == ax1 else k, v) for k, v in self.axes.items()))
+        self.views = {}
 
         # modify data
         self.data = [(name,
@@ -2251,64 +4243,205 @@ class MLUT(object):
         return ds
 
 
-def read_mlut(filename, fmt=None):
+def read_mlut(filename, fmt=None, datasets=None, sub=None):
     '''
     Read a MLUT (multi-format)
-    fmt: netcdf4, hdf4
+    fmt: netcdf4, hdf4, hdf5, mmap
          or None (determine format from extension)
+    datasets: list of datasets to read (default None: all datasets)
+    sub: dictionary {axis_name: key} for reading a subset of the MLUT (see
+         MLUT.sub). For the netcdf4, hdf5 and mmap formats, only the
+         hyperslabs required by these keys are read.
+
+    Example:
+    >>> read_mlut('lut.nc', datasets=['rho'], sub={'wav': Idx(865.)})
     '''
     if fmt is None:
         if filename.endswith('.hdf'):
             fmt = 'hdf4'
         elif filename.endswith('.nc'):
             fmt = 'netcdf4'
+        elif filename.endswith('.mlut'):
+            fmt = 'mmap'
         else:
             raise ValueError('Cannot determine desired format '
                     'of filename "{}"'.format(filename))
 
+    # with sub, the datasets are read lazily, then subsetted
+    lazy = (sub is not None)
+
     if fmt=='netcdf4':
-        return read_mlut_netcdf4(filename)
+        m = read_mlut_netcdf4(filename, datasets=datasets, lazy=lazy)
     elif fmt=='hdf4':
-        return read_mlut_hdf(filename)
+        m = read_mlut_hdf(filename, datasets=datasets)
     elif fmt=='hdf5':
-        return read_mlut_hdf5(filename)
+        m = read_mlut_hdf5(filename, datasets=datasets, lazy=lazy)
+    elif fmt=='mmap':
+        m = read_mlut_mmap(filename, datasets=datasets)
 
     else:
         raise ValueError('Invalid format {}'.format(fmt))
 
+    if sub is not None:
+        with m:
+            m = m.sub(sub)
+            m.load()
+
+    return m
+
+
+class LazyArray(object):
+    '''
+    Array-like proxy to a variable stored in a file (like a netCDF4
+    Variable), which is read on demand
+
+    Indexing follows the numpy semantics (integer and boolean arrays...),
+    and reads only the hyperslab containing the indexed elements.
+    The reads are serialized by a lock, so that the LUT can be used from
+    several threads.
+    '''
+    def __init__(self, var, lock=None):
+        self.var = var
+        self.shape = tuple(var.shape)
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(var.dtype)
+        self.size = int(np.prod(self.shape))
+        self.nbytes = self.size*self.dtype.itemsize
+        if lock is None:
+            lock = FILE_LOCK
+        self.lock = lock
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, keys):
+        if not isinstance(keys, tuple):
+            keys = (keys,)
+        keys = [np.asarray(k) if isinstance(k, list) else k for k in keys]
+        ellipsis = [(k is Ellipsis) for k in keys]
+        if True in ellipsis:
+            i = ellipsis.index(True)
+            keys = keys[:i] + [slice(None)]*(self.ndim-len(keys)+1) + keys[i+1:]
+        if len(keys) > self.ndim:
+            raise IndexError('too many indices for LazyArray')
+        keys += [slice(None)]*(self.ndim-len(keys))
+
+        slab, keys = hyperslab(keys, self.shape)
+        with self.lock:
+            if self.ndim == 0:
+                data = filled(self.var[...])
+            else:
+                data = filled(self.var[tuple(slab)])
+
+        data = np.asarray(data)[tuple(keys)]
+        if True in ellipsis:
+            # like numpy, indexing with an ellipsis returns an array
+            data = np.asarray(data)
+
+        return data
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.asarray(self[...])
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
 
-def read_mlut_netcdf4(filename):
+    def __repr__(self):
+        return 'LazyArray(shape={}, dtype={})'.format(self.shape, self.dtype)
+
+
+def read_mlut_netcdf4(filename, datasets=None, lazy=False):
     '''
     Read a MLUT (netcdf4 format)
+
+    datasets: list of datasets to read (default None: all datasets)
+    lazy: if True, the datasets are not read but returned as LazyArray,
+          which read the data on demand (only the hyperslabs required for
+          indexing the LUTs, or for subsetting them with sub). The file is
+          kept open until the MLUT is closed (MLUT.close).
     '''
-    # assumes everything is in the root group
-    m = MLUT()
-    from netCDF4 import Dataset
-    root = Dataset(filename, 'r', format='NETCDF4')
+    with FILE_LOCK:
+        # assumes everything is in the root group
+        m = MLUT()
+        from netCDF4 import Dataset
+        root = Dataset(filename, 'r', format='NETCDF4')
 
-    # read axes
-    for dim in root.dimensions:
-        if (not dim.startswith('dummy')) and (dim in root.variables):
+        axes = [dim for dim in root.dimensions
+                if (not dim.startswith('dummy')) and (dim in root.variables)]
+        if datasets is None:
+            datasets = [varname for varname in root.variables
+                        if varname not in axes]
+        else:
+            for varname in datasets:
+                if varname not in root.variables:
+                    raise Exception('Cannot find dataset {} in {}'.format(varname, filename))
+            # read only the axes of these datasets
+            dims = sum([list(root.variables[varname].dimensions)
+                        for varname in datasets], [])
+            axes = [dim for dim in axes if dim in dims]
+
+        # read axes
+        for dim in axes:
             m.add_axis(str(dim), filled(root.variables[dim][:]))
 
-    # read datasets
-    for varname in root.variables:
-        if varname in m.axes:
-            continue
-        var = root.variables[varname]
+        # read datasets
+        for varname in datasets:
+            var = root.variables[varname]
 
-        # read attributes
-        attrs = {}
-        for a in var.ncattrs():
-            attrs[a] = var.getncattr(a)
+            # read attributes
+            attrs = {}
+            for a in var.ncattrs():
+                attrs[a] = var.getncattr(a)
 
-        m.add_dataset(varname, filled(var[:]), [str(x) for x in var.dimensions], attrs=attrs)
+            if lazy:
+                data = LazyArray(var)
+            else:
+                data = filled(var[:])
 
-    # read global attributes
-    for a in root.ncattrs():
-        m.set_attr(a, root.getncattr(a))
+            m.add_dataset(varname, data, [str(x) for x in var.dimensions], attrs=attrs)
 
-    root.close()
+        # read global attributes
+        for a in root.ncattrs():
+            m.set_attr(a, root.getncattr(a))
+
+        if lazy:
+            m.files.append(root)
+        else:
+            root.close()
+
+        return m
+
+
+def read_mlut_mmap(filename, datasets=None, mode='r'):
+    '''
+    Read a MLUT saved in mmap format (MLUT.save(..., fmt='mmap'))
+
+    The datasets are memory-mapped (numpy.memmap) instead of being read:
+    the data is loaded on demand, and the memory is shared between the
+    processes reading the same file.
+    datasets: list of datasets to read (default None: all datasets)
+    mode: mode of numpy.memmap ('r': read-only, 'c': copy-on-write)
+    '''
+    header, start = read_mmap_header(filename)
+
+    if datasets is not None:
+        names = [desc['name'] for desc in header['datasets']]
+        for name in datasets:
+            if name not in names:
+                raise Exception('Cannot find dataset {} in {}'.format(name, filename))
+        header['datasets'] = [desc for desc in header['datasets']
+                              if desc['name'] in datasets]
+        dims = sum([desc['axnames'] for desc in header['datasets']], [])
+        header['axes'] = [desc for desc in header['axes']
+                          if desc['name'] in dims]
+
+    m = MLUT()
+    for desc in header['axes']:
+        m.add_axis(desc['name'], np.array(mmap_array(filename, desc, start)))
+    for desc in header['datasets']:
+        m.add_dataset(desc['name'], mmap_array(filename, desc, start, mode=mode),
+                      desc['axnames'], attrs=desc['attrs'])
+    m.set_attrs(header['attrs'])
 
     return m
 
@@ -2394,7 +4527,13 @@ def read_mlut_hdf5(filename, datasets=None, lazy=False, group=None, wrap_data=No
             attrs['scale_factor'] = f['data'][dataset].attrs.get('scale_factor')
         m.add_dataset(dataset, data, axnames=axis_data[idata], attrs=attrs)
 
-    if not lazy:
+    # read global attributes
+    for a, v in f.attrs.items():
+        m.set_attr(a, v)
+
+    if lazy:
+        m.files.append(ff)
+    else:
         ff.close()
 
     return m
@@ -2411,74 +4550,75 @@ def read_mlut_hdf(filename, datasets=None):
             - or a tuple (dataset_name, axes) where axes is a list of
               dimensions (strings), overriding the attribute 'dimensions'
     '''
-    from pyhdf.SD import SD
-
-    hdf = SD(filename)
+    with FILE_LOCK:
+        from pyhdf.SD import SD
 
-    # read the datasets
-    ls_axes = []
-    ls_datasets = []
-    if datasets is None:
-        datasets = xrange(len(hdf.datasets()))
-    else:
-        assert isinstance(datasets, list), 'datasets should be provided as a list'
+        hdf = SD(filename)
 
-    for i in datasets:
-        if isinstance(i, tuple):
-            (name, axes) = i
-            sds = hdf.select(name)
+        # read the datasets
+        ls_axes = []
+        ls_datasets = []
+        if datasets is None:
+            datasets = xrange(len(hdf.datasets()))
         else:
-            axes = None
-            sds = hdf.select(i)
-        sdsname = sds.info()[0]
+            assert isinstance(datasets, list), 'datasets should be provided as a list'
 
-        if (axes is None) and ('dimensions' in sds.attributes()):
-            axes = sds.attributes()['dimensions'].split(',')
-            axes = [x.strip() for x in axes]
+        for i in datasets:
+            if isinstance(i, tuple):
+                (name, axes) = i
+                sds = hdf.select(name)
+            else:
+                axes = None
+                sds = hdf.select(i)
+            sdsname = sds.info()[0]
 
-            # replace 'None's by None
-            axes = [None if (x=='None') else x for x in axes]
+            if (axes is None) and ('dimensions' in sds.attributes()):
+                axes = sds.attributes()['dimensions'].split(',')
+                axes = [x.strip() for x in axes]
 
-        if axes is not None:
-            ls_axes.extend(axes)
+                # replace 'None's by None
+                axes = [None if (x=='None') else x for x in axes]
 
-        data = sds.get()
-        attrs = sds.attributes()
-        if 'lut:scalar' in attrs:
-            attrs.pop('lut:scalar')
-            data = data.reshape(())
-        ls_datasets.append((sdsname, data, axes, attrs))
+            if axes is not None:
+                ls_axes.extend(axes)
 
-    # remove 'None' axes
-    while None in ls_axes:
-        ls_axes.remove(None)
+            data = sds.get()
+            attrs = sds.attributes()
+            if 'lut:scalar' in attrs:
+                attrs.pop('lut:scalar')
+                data = data.reshape(())
+            ls_datasets.append((sdsname, data, axes, attrs))
 
-    # transfer the axes from ls_datasets to the new MLUT
-    m = MLUT()
-    for ax in set(ls_axes):
-        [x[0] for x in ls_datasets]
-
-        # read the axis if not done already
-        if ax not in [x[0] for x in ls_datasets]:
-            if ax in hdf.datasets():
-                sds = hdf.select(ax)
-                m.add_axis(ax, sds.get())
-        else:
-            i = [x[0] for x in ls_datasets].index(ax)
-            (name, data, _, _) = ls_datasets.pop(i)
-            m.add_axis(name, data)
-
-    # add the datasets
-    for (name, data, axnames, attrs) in ls_datasets:
-        if 'dimensions' in attrs:
-            attrs.pop('dimensions')
-        m.add_dataset(name, data, axnames, attrs)
-
-    # read the global attributes
-    for k, v in hdf.attributes().items():
-        m.set_attr(k, v)
+        # remove 'None' axes
+        while None in ls_axes:
+            ls_axes.remove(None)
 
-    return m
+        # transfer the axes from ls_datasets to the new MLUT
+        m = MLUT()
+        for ax in set(ls_axes):
+            [x[0] for x in ls_datasets]
+
+            # read the axis if not done already
+            if ax not in [x[0] for x in ls_datasets]:
+                if ax in hdf.datasets():
+                    sds = hdf.select(ax)
+                    m.add_axis(ax, sds.get())
+            else:
+                i = [x[0] for x in ls_datasets].index(ax)
+                (name, data, _, _) = ls_datasets.pop(i)
+                m.add_axis(name, data)
+
+        # add the datasets
+        for (name, data, axnames, attrs) in ls_datasets:
+            if 'dimensions' in attrs:
+                attrs.pop('dimensions')
+            m.add_dataset(name, data, axnames, attrs)
+
+        # read the global attributes
+        for k, v in hdf.attributes().items():
+            m.set_attr(k, v)
+
+        return m
 
 def from_xarray(A):
     """
@@ -9,7 +9,8 @@ import warnings
 import numpy as np
 import pytest
 
-from luts import LUT, MLUT, Idx, merge, read_mlut, read_mlut_hdf
+from luts import LUT, MLUT, Idx, merge, merge_files, read_mlut, read_mlut_hdf
+from luts.luts import AxisIndex, LazyArray, read_mlut_netcdf4
 
 
 def create_mlut():
@@ -42,7 +43,7 @@ def test_scalar():
     (m['scalar']+m['scalar']).apply(np.sqrt).print_info()
 
     m.describe()
-    for fmt in ['hdf4', 'netcdf4']:
+    for fmt in ['hdf4', 'netcdf4', 'mmap']:
         with tempfile.NamedTemporaryFile() as f:
             m.save(f.name, overwrite=True, verbose=True, fmt=fmt)
             assert m.equal(read_mlut(f.name, fmt=fmt), show_diff=True)
@@ -149,6 +150,106 @@ def test_getitem():
     l[2.5, np.ones((4, 4), dtype='float')*1.5]
     l[Idx(100.), Idx(np.ones((4, 4))*1000.)]
 
+def test_getitem_indexing():
+    # without interpolation, the data is indexed directly
+    l = create_lut()
+    assert l[1, 2] == l.data[1, 2]
+    assert np.array_equal(l[1, :], l.data[1, :])
+    assert np.array_equal(l[np.arange(2), 3], l.data[np.arange(2), 3])
+    idx = Idx(lambda x: x > 1000., 'P0')
+    assert np.array_equal(l[:, idx], l.data[:, l.axes[1] > 1000.])
+    with pytest.raises(Exception):
+        l[:, Idx(lambda x: x > 1000., 'z')]
+    with pytest.raises(Exception):
+        l[1]
+
+
+def test_sub_view():
+    l = create_lut()
+    for d in [{'z': slice(0, 10)}, {'P0': 2}, {'z': slice(None, None, -2), 'P0': Idx(1000.,round=True)}]:
+        s = l.sub(d)
+        assert np.shares_memory(s.data, l.data)
+        c = l.sub(d, copy=True)
+        assert not np.shares_memory(c.data, l.data)
+        assert np.array_equal(s.data, c.data)
+    # interpolation or advanced indexing
+    assert not np.shares_memory(l.sub({'z': 1.5}).data, l.data)
+    assert not np.shares_memory(l.sub({'z': np.arange(3)}).data, l.data)
+
+    m = create_mlut()
+    s = m.sub({'a': slice(1, 3)})
+    assert np.shares_memory(s['data2'].data, m['data2'].data)
+    s = m.sub({'a': slice(1, 3)}, copy=True)
+    assert not np.shares_memory(s['data2'].data, m['data2'].data)
+
+
+def test_mlut_sub_shared(monkeypatch):
+    m = create_mlut()
+    m.add_dataset('data4', np.random.rand(5, 6), ['a', 'b'])
+    m.add_dataset('scalar', np.array(2.))
+    d = {'a': Idx(np.linspace(100, 150, 11)), 'b': Idx(6.2), 'c': 3}
+    ref = dict([(name, m[name].sub(d, ignore=True)) for name in m.datasets()])
+
+    # each Idx is resolved once
+    calls = []
+    index = AxisIndex.index
+    def count(self, *args, **kwargs):
+        calls.append(self)
+        return index(self, *args, **kwargs)
+    monkeypatch.setattr(AxisIndex, 'index', count)
+    s = m.sub(d)
+    assert len(calls) == 2
+
+    assert s.datasets() == m.datasets()
+    for name in m.datasets():
+        assert s[name].names == ref[name].names
+        assert np.allclose(s[name].data, ref[name].data)
+
+
+def test_mlut_interp():
+    m = create_mlut()
+    m.add_dataset('data4', np.random.rand(5, 6), ['a', 'b'])
+    a = np.linspace(100, 150, 11)
+    b = np.linspace(6.1, 6.9, 11)
+    res = m.interp({'a': a, 'b': Idx(b)}, datasets=['data2', 'data4', 'data1'])
+    assert list(res) == ['data2', 'data4', 'data1']
+    for name in res:
+        lut = m[name]
+        keys = [Idx(a) if n == 'a' else (Idx(b) if n == 'b' else slice(None))
+                for n in lut.names]
+        assert np.allclose(res[name], lut[tuple(keys)])
+
+
+def test_mlut_vector():
+    m = create_mlut()
+    m.add_dataset('data4', np.random.rand(5, 6, 7), ['a', 'b', 'c'])
+    V = m.vector(['data2', 'data4'])
+    assert V.names == ['a', 'b', 'c', 'dataset']
+    assert V.attrs['datasets'] == ['data2', 'data4']
+    assert V.data.flags.c_contiguous
+    a = np.linspace(100, 150, 11)
+    b = np.linspace(6.1, 6.9, 11)
+    res = V[Idx(a), Idx(b), 3, :]
+    assert res.shape == (11, 2)
+    ref = m.interp({'a': a, 'b': b, 'c': m.axes['c'][3]}, datasets=['data2', 'data4'])
+    assert np.allclose(res[:, 0], ref['data2'])
+    assert np.allclose(res[:, 1], ref['data4'])
+    res = V[:, Idx(b), Idx(0.5), :]
+    assert res.shape == (5, 11, 2)
+    assert np.allclose(res[..., 1], m['data4'][:, Idx(b), Idx(0.5)])
+    assert np.allclose(V[Idx(120.), Idx(6.5), Idx(0.5), :],
+                       [m['data2'][Idx(120.), Idx(6.5), Idx(0.5)],
+                        m['data4'][Idx(120.), Idx(6.5), Idx(0.5)]])
+
+    # vector LUT from a LUT
+    L = m['data2'].vector('a')
+    assert L.names == ['b', 'c', 'a']
+    assert L.data.flags.c_contiguous
+    assert np.allclose(L[Idx(b), Idx(0.5), :], m['data2'][:, Idx(b), Idx(0.5)].T)
+
+    with pytest.raises(Exception):
+        m.vector(['data1', 'data2'])
+
 
 def test_sub2():
     # test more complex subsetting
@@ -216,6 +317,25 @@ def test_reduce_2():
     l.reduce(np.sum, 'P0', grouping=(P0<1000))
 
 
+@pytest.mark.parametrize('fn', [np.sum, np.mean, np.min, np.max, np.average])
+def test_reduce_grouped(fn):
+    # segment reduction vs generic reduction (fn wrapped in a lambda)
+    np.random.seed(0)
+    l = LUT(np.random.rand(4, 50), axes=[None, np.arange(50.)], names=['a', 'b'])
+    grouping = np.random.randint(0, 10, 50)
+    r1 = l.reduce(fn, 'b', grouping=grouping)
+    r2 = l.reduce(lambda x, axis: fn(x, axis=axis), 'b', grouping=grouping)
+    assert r1.axes[1] == r2.axes[1]
+    assert np.allclose(r1.data, r2.data)
+
+    # weighted mean
+    w = np.random.rand(50)
+    r = l.reduce(np.average, 'b', grouping=grouping, weights=w)
+    g = r.axes[1][3]
+    assert np.allclose(r.data[:, 3], np.average(l.data[:, grouping == g], axis=1,
+                                                 weights=w[grouping == g]))
+
+
 def test_indexing():
     m = create_mlut()
     for i, d in enumerate(m.datasets()):
@@ -387,6 +507,99 @@ def test_oper_lut2():
     m.desc = 'another'
     assert (l+m).desc != l.desc
 
+def test_lut_new():
+    l = create_lut()
+    assert not hasattr(l, '__dict__')
+    # the derived LUTs share the axes, names and attributes
+    for r in [l*2+1, l.apply(np.sqrt)]:
+        assert r.axes is l.axes
+        assert r.names is l.names
+        assert r.attrs is l.attrs
+        assert r.shape == l.shape
+        assert r.axis_index('z') is l.axis_index('z')
+    s = l.swapaxes('z', 'P0')
+    assert s.names == ['P0', 'z']
+    assert s.shape == (6, 80)
+    assert s.axes[1] is l.axes[0]
+    assert np.allclose(s[Idx(1000.), Idx(10.)], l[Idx(10.), Idx(1000.)])
+    r = l.reduce(np.sum, 'z')
+    assert r.names == ['P0']
+    assert r.formatter == l.formatter
+
+def test_lut_inplace():
+    l = create_lut()
+    ref = l.data.copy()
+    data = l.data
+    P0 = l.sub({'z': 0}).apply(np.copy)
+    z = l.sub({'P0': 0}).apply(np.copy)
+    r = l
+    r *= 2
+    r += z
+    r -= 1.
+    r /= P0
+    assert r is l
+    assert l.data is data
+    assert np.allclose(l.data, (ref*2 + ref[:, :1] - 1.)/ref[:1, :])
+
+    # the result has more axes, or another type: out-of-place
+    r = z
+    r += P0
+    assert r is not z
+    assert r.shape == (80, 6)
+    i = LUT(np.arange(5))
+    r = i
+    r /= 2
+    assert r is not i
+    assert np.allclose(r.data, np.arange(5)/2)
+    assert i.data.dtype.kind == 'i'
+
+def test_lut_expr():
+    np.random.seed(1)
+    a = LUT(np.random.rand(4, 5)+1, axes=[np.linspace(0, 1, 4), np.linspace(0, 2, 5)],
+            names=['x', 'y'], desc='a')
+    b = LUT(np.random.rand(5, 3)+1, axes=[np.linspace(0, 2, 5), np.linspace(10, 20, 3)],
+            names=['y', 'z'], desc='b')
+    c = LUT(np.random.rand(3)+1, axes=[np.linspace(10, 20, 3)], names=['z'])
+    ref = (a*b + c)/a - 2
+    E = (a.lazy()*b + c)/a - 2
+    assert E.names == ['x', 'y', 'z']
+    assert E.shape == (4, 5, 3)
+    for chunk_size in [None, 7]:
+        r = E.compute(chunk_size=chunk_size)
+        assert r.names == ref.names
+        assert np.allclose(r.data, ref.data)
+
+    # interpolation at points
+    x, y, z = np.random.rand(10), 2*np.random.rand(10), 10+10*np.random.rand(10)
+    assert np.allclose(E[Idx(x), Idx(y), Idx(z)], ref[Idx(x), Idx(y), Idx(z)])
+    assert np.allclose(E[1, Idx(y), 2.5], ref[1, Idx(y), 2.5])
+
+    # operations with LUTs, numpy scalars and functions
+    assert np.allclose((np.float64(2)*a + b.lazy()).compute().data, (2*a + b).data)
+    assert np.allclose(a.lazy().apply(np.sqrt).compute().data, np.sqrt(a.data))
+
+def test_lut_expr_operandwise():
+    np.random.seed(2)
+    t = LUT(np.random.rand(6, 5, 4), axes=[np.linspace(0, 1, 6), np.linspace(0, 1, 5), np.arange(4.)],
+            names=['x', 'y', 'w'])
+    r = LUT(np.random.rand(7, 4), axes=[np.linspace(0, 1, 7), np.arange(4.)],
+            names=['z', 'w'])
+    x, y, z = np.random.rand(3, 20)
+    keys = (Idx(x), Idx(y), Idx(z), 2)
+    for E, ref in [(t.lazy()*r, t*r),              # no common interpolated axis
+                   (t.lazy()/r + 2*t, t/r + 2*t),
+                   (t.lazy()*r + t.lazy()*t, t*r + t*t),
+                   ]:
+        assert E.names == ['x', 'y', 'z', 'w']
+        assert np.allclose(E[keys], ref[keys])
+
+    # approximate operand-wise interpolation
+    keys = (Idx(x), Idx(y), 2)
+    E = t.lazy()*t
+    assert np.allclose(E[keys], (t*t)[keys])
+    assert np.allclose(E.interp(keys, operandwise=True), t[keys]**2)
+    assert not np.allclose(E[keys], t[keys]**2)
+
 def test_lut_apply():
     l = create_lut()
     m = l.apply(np.sqrt)
@@ -396,7 +609,7 @@ def test_lut_apply():
     assert np.allclose(m.data, np.sqrt(l.data))
 
 
-@pytest.mark.parametrize('filename', ['mlut.hdf', 'mlut.nc'])
+@pytest.mark.parametrize('filename', ['mlut.hdf', 'mlut.nc', 'mlut.mlut'])
 def test_write_read_mlut(filename):
 
     # write a mlut, read it again, should be equal
@@ -470,6 +683,50 @@ def test_rm_lut():
     m = create_mlut()
     m.rm_lut('data1')
 
+def test_mlut_datasets_order():
+    m = create_mlut()
+    for i in range(100):
+        m.add_dataset('x{}'.format(i), np.full((5,), i), ['a'])
+    m.rm_lut('data2')
+    m.rm_lut('x50')
+    names = ['data1', 'data3'] + ['x{}'.format(i) for i in range(100) if i != 50]
+    assert m.datasets() == names
+    assert [x[0] for x in m.data] == names
+    assert [l.desc for l in m] == names
+    assert m[2].desc == 'x0'
+    assert m[-1].desc == 'x99'
+    assert m['x51'].data[0] == 51
+    with pytest.raises(AssertionError):
+        m.add_dataset('x51', np.zeros(5), ['a'])
+    with pytest.raises(Exception):
+        m.rm_lut('x50')
+    with pytest.raises(Exception):
+        m['x50']
+
+    # the datasets can be replaced by assigning data
+    m.data = m.data[::-1]
+    assert m.datasets() == names[::-1]
+
+def test_mlut_views():
+    m = create_mlut()
+    l = m['data1']
+    assert m['data1'] is l
+    assert m[0] is l
+    # invalidation
+    m.add_axis('d', np.arange(10))
+    assert m['data1'] is not l
+    l = m['data1']
+    m.rename_axis('a', 'x')
+    assert m['data1'].names == ['x', 'b']
+    m.rm_lut('data1')
+    m.add_dataset('data1', np.zeros((5, 6)), ['x', 'b'])
+    assert np.all(m['data1'].data == 0)
+    m.axes['b'] = m.axes['b'] + 1
+    assert m['data1'].axes[1] is m.axes['b']
+    # a modified LUT is not reused
+    m['data1'].rename_axis('b', 'y')
+    assert m['data1'].names == ['x', 'b']
+
 def test_rename_lut():
     l = create_lut()
     l.describe()
@@ -484,3 +741,360 @@ def test_rename_mlut():
 def test_plot_polar():
     m = create_mlut()
     m['data1'].plot_polar()
+
+def test_interp_plan():
+    l = create_lut()
+    plan = l.plan(Idx(0., 'z'), Idx(1000.))
+    assert plan() == l[Idx(0.), Idx(1000.)]
+    z = np.random.rand(5, 4)*100
+    P0 = 1000+20*np.random.rand(5, 4)
+    assert np.allclose(plan(z, P0), l[Idx(z), Idx(P0)])
+
+    # fixed and float keys
+    plan = l.plan(1.5, slice(None))
+    assert np.allclose(plan(2.5), l[2.5, :])
+    plan = l.plan(slice(None), Idx(1000., round=True))
+    assert np.allclose(plan(1013.), l[:, Idx(1013., round=True)])
+
+@pytest.mark.parametrize('keys', [
+    (Idx(np.linspace(0, 120, 10)), Idx(1000.)),
+    (slice(None), Idx(np.linspace(980, 1030, 10))),
+    (2.3, slice(1, None, 2)),
+    (np.random.rand(2, 3)*70, np.zeros((2, 3), dtype='int')),
+    (Idx(np.random.rand(2, 3)*120), Idx(np.random.rand(2, 3)*50 + 980)),
+])
+def test_interp_engines(keys):
+    l = create_lut()
+    fused = l.plan(*keys, engine='fused')()
+    loop = l.plan(*keys, engine='loop')()
+    assert fused.shape == loop.shape
+    assert np.allclose(fused, loop)
+
+@pytest.mark.parametrize('engine', ['fused', 'loop'])
+def test_interp_chunked(engine):
+    l = create_lut()
+    z = np.random.rand(20, 30)*120
+    P0 = np.random.rand(20, 30)*50 + 980
+    for keys in [(Idx(z), Idx(P0)),
+                 (Idx(z), slice(None)),
+                 (z/2, 3)]:
+        ref = l[keys]
+        res = l.interp(keys, engine=engine, chunk_size=7)
+        assert res.shape == ref.shape
+        assert np.allclose(res, ref)
+
+@pytest.mark.parametrize('chunk_size', [None, 13])
+def test_interp_workers(chunk_size):
+    l = create_lut()
+    z = np.random.rand(50, 30)*120
+    P0 = np.random.rand(50, 30)*50 + 980
+    ref = l[Idx(z), Idx(P0)]
+    res = l.interp((Idx(z), Idx(P0)), chunk_size=chunk_size, workers=4)
+    assert np.array_equal(res, ref)
+    plan = l.plan(Idx(0.), slice(None), workers=3)
+    assert np.array_equal(plan(z), l[Idx(z), :])
+
+@pytest.mark.parametrize('axis', [
+    np.linspace(0, 100, 11),        # regular
+    np.linspace(100, 0, 11),        # regular, decreasing
+    np.array([1., 2., 4., 8., 9.]), # irregular
+    np.array([9., 8., 4., 2., 1.]), # irregular, decreasing
+    np.array([0., 3., 1., 5.]),     # not monotonic
+])
+@pytest.mark.parametrize('fill_value', [None, np.nan, (0, -1), 'extrapolate'])
+def test_axis_index(axis, fill_value):
+    from scipy.interpolate import interp1d
+    vmin, vmax = np.amin(axis), np.amax(axis)
+    values = [vmin, vmax, 0.3*vmin+0.7*vmax,
+              vmin + np.random.rand(30, 40)*(vmax-vmin),
+              axis[2:]]
+    if fill_value is not None:
+        values.append(np.array([vmin-1, vmax+1, np.nan]))
+    for v in values:
+        ref = interp1d(axis, np.arange(len(axis)),
+                       bounds_error=(fill_value is None),
+                       fill_value=fill_value)(v)
+        res = AxisIndex(axis).interp(v, fill_value=fill_value)
+        assert res.shape == ref.shape
+        assert np.allclose(res, ref, equal_nan=True)
+    if fill_value is None:
+        with pytest.raises(ValueError):
+            AxisIndex(axis).interp(vmax+1)
+
+
+def test_axis_cache():
+    m = create_mlut()
+    l1, l2 = m['data1'], m['data2']
+    assert l1.axis_index('a') is l2.axis_index('a')
+    assert m['data1'].axis_index('b') is l1.axis_index('b')
+    # sub keeps the cache of the unchanged axes
+    s = l1.sub({'a': slice(1, None)})
+    assert s.axis_index('b') is l1.axis_index('b')
+    assert s.axis_index('a') is not l1.axis_index('a')
+    assert s.axis_index('a').size == len(s.axis('a'))
+    # a new axis object is analysed again
+    m.axes['a'] = m.axes['a'] + 1.
+    assert m['data1'].axis_index('a') is not l1.axis_index('a')
+    assert np.allclose(m['data1'].sub({'a': Idx(m.axes['a'][1])}).data,
+                       m['data1'].data[1])
+
+
+def test_read_mlut_mmap():
+    m0 = create_mlut()
+    m0.add_dataset('data4', np.arange(12, dtype='int16').reshape(3, 4)[:, ::2])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'mlut.mlut')
+        m0.save(filename)
+        m1 = read_mlut(filename)
+        assert m0.equal(m1, show_diff=True)
+        assert isinstance(m1['data2'].data, np.memmap)
+        assert m1['data2'][Idx(120.), :, 2].shape == (6,)
+        assert np.allclose(m1['data2'][Idx(120.), :, 2],
+                           m0['data2'][Idx(120.), :, 2])
+
+
+@pytest.mark.parametrize('keys', [
+    (Idx(120.), slice(None), 2),
+    (np.array([4, -1]), slice(None, None, -2), Idx(np.array([0.2, 0.7]))),
+    (1, 2.5, slice(1, 4)),
+    (Ellipsis, 3),
+])
+def test_read_mlut_netcdf4_lazy(keys):
+    m0 = create_mlut()
+    m0.add_dataset('scalar', np.array(2.5), [])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'mlut.nc')
+        m0.save(filename)
+        with read_mlut_netcdf4(filename, lazy=True) as m1:
+            assert isinstance(m1['data2'].data, LazyArray)
+            assert m0.equal(m1, show_diff=True)
+            if keys[0] is Ellipsis:
+                ref, res = m0['data2'].data[keys], m1['data2'].data[keys]
+            else:
+                ref, res = m0['data2'][keys], m1['data2'][keys]
+            assert res.shape == ref.shape
+            assert np.allclose(res, ref)
+            assert m1['data2'].sub({'b': Idx(6.5)}) == m0['data2'].sub({'b': Idx(6.5)})
+
+            # scalar dataset
+            assert np.asarray(m1['scalar'].data).shape == ()
+            assert m1['scalar'].data[...].shape == ()
+            assert m1['scalar'].data[()] == 2.5
+
+            # LUT operations on lazy data
+            assert (m1['data2'] + 1) == (m0['data2'] + 1)
+            assert (m1['data2'] * m1['data1']) == (m0['data2'] * m0['data1'])
+            assert m1['data2'].swapaxes('a', 'c') == m0['data2'].swapaxes('a', 'c')
+            assert m1['data2'].apply(np.abs) == m0['data2'].apply(np.abs)
+            assert m1['data2'].reduce(np.sum, 'b') == m0['data2'].reduce(np.sum, 'b')
+
+
+@pytest.mark.parametrize('filename', ['mlut.hdf', 'mlut.nc', 'mlut.mlut'])
+def test_read_mlut_sub(filename):
+    m0 = create_mlut()
+    m0.add_dataset('scalar', np.array(2.5), [])
+    sub = {'a': Idx(112.), 'b': slice(1, 4)}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, filename)
+        m0.save(filename)
+        m1 = read_mlut(filename, datasets=['data2'])
+        assert m1.datasets() == ['data2']
+        assert sorted(m1.axes) == ['a', 'b', 'c']
+        m2 = read_mlut(filename, datasets=['data1', 'data2'], sub=sub)
+        for d in ['data1', 'data2']:
+            assert m2[d] == m0[d].sub(sub)
+            assert isinstance(m2[d].data, np.ndarray)
+        assert m2.files == []
+
+        # sub on an axis which is not in all datasets (including a scalar)
+        m3 = read_mlut(filename, sub={'c': 2})
+        for d in m0.datasets():
+            assert m3[d] == m0[d].sub({'c': 2}, ignore=True)
+            assert isinstance(m3[d].data, np.ndarray)
+
+
+@pytest.mark.parametrize('mode', ['list', 'files', 'filenames_iterator', 'generator', 'mmap'])
+def test_merge_stream(mode):
+    def mluts():
+        for p1 in np.arange(3):
+            for p2 in np.arange(2):
+                m = create_mlut()
+                m.set_attr('p1', p1)
+                m.set_attr('p2', p2)
+                m.set_attr('p3', p1*p2)
+                yield m
+
+    ref = merge(list(mluts()), ['p1', 'p2'])
+    assert 'x' in ref.attrs
+    assert 'p3' not in ref.attrs
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        kwargs = {}
+        if mode == 'list':
+            M = list(mluts())
+        elif mode in ['files', 'filenames_iterator']:
+            M = []
+            for i, m in enumerate(mluts()):
+                M.append(os.path.join(tmpdir, 'mlut{}.nc'.format(i)))
+                m.save(M[-1])
+            if mode == 'filenames_iterator':
+                M = iter(M)
+        else:
+            M = mluts()
+            kwargs['axis_values'] = {'p1': np.arange(3), 'p2': np.arange(2)}
+            if mode == 'mmap':
+                kwargs['filename'] = os.path.join(tmpdir, 'merged.mlut')
+        m = merge(M, ['p1', 'p2'], **kwargs)
+        assert m.equal(ref, show_diff=True)
+
+    # a generator of MLUTs requires the values of the new axes
+    with pytest.raises(Exception, match='axis_values'):
+        merge(mluts(), ['p1', 'p2'])
+
+
+@pytest.mark.parametrize('ext', ['nc', 'h5'])
+def test_merge_chunked(ext):
+    def mluts():
+        for p1 in np.arange(3):
+            m = create_mlut()
+            m.rm_lut('data3')  # no axis names
+            m.set_attr('p1', p1)
+            yield m
+
+    ref = merge(list(mluts()), ['p1'], axis_values={'p1': np.arange(4)})
+    assert np.isnan(ref['data2'][3, 0, 0, 0])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'merged.'+ext)
+        m = merge(mluts(), ['p1'], axis_values={'p1': np.arange(4)},
+                  filename=filename)
+        with m:
+            # missing elements are NaN
+            assert m.equal(ref, content=False, show_diff=True)
+            for name in ref.datasets():
+                assert np.allclose(m[name].data[...], ref[name].data,
+                                   equal_nan=True)
+            assert m['data2'].shape == (4, 5, 6, 7)
+            assert np.allclose(m['data2'][Idx(1.5), 2, 3, 4],
+                               ref['data2'][Idx(1.5), 2, 3, 4])
+        if ext == 'nc':
+            from netCDF4 import Dataset
+            with Dataset(filename) as root:
+                assert root.variables['data2'].chunking() == [1, 5, 6, 7]
+        else:
+            import h5py
+            with h5py.File(filename, 'r') as f:
+                assert f['data/data2'].chunks == (1, 5, 6, 7)
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_merge_files(executor):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        M = []
+        filenames = []
+        for p1 in np.arange(4):
+            m = create_mlut()
+            m.set_attr('p1', p1)
+            M.append(m)
+            filenames.append(os.path.join(tmpdir, 'mlut{}.nc'.format(p1)))
+            m.save(filenames[-1])
+        ref = merge(M, ['p1'])
+        m = merge_files(filenames, ['p1'], workers=2, executor=executor)
+        assert m.equal(ref, show_diff=True)
+        target = os.path.join(tmpdir, 'merged.mlut')
+        m = merge_files(filenames, ['p1'], workers=2, executor=executor,
+                        target=target)
+        assert m.equal(ref, show_diff=True)
+        assert m.equal(read_mlut(target), show_diff=True)
+
+
+def test_merge_sort():
+    M = []
+    for p1 in [3, 1, 2]:
+        m = create_mlut()
+        m.set_attr('p1', p1)
+        M.append(m)
+    m = merge(M, ['p1'], sort=True)
+    assert list(m.axes['p1']) == [1, 2, 3]
+    assert np.allclose(m['data1'].data[0], M[1]['data1'].data)
+    assert list(merge(M, ['p1']).axes['p1']) == [3, 1, 2]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filenames = []
+        for i, m in enumerate(M):
+            filenames.append(os.path.join(tmpdir, 'mlut{}.nc'.format(i)))
+            m.save(filenames[-1])
+        m = merge_files(filenames, ['p1'], workers=2, executor='thread', sort=True)
+        assert m.equal(merge(M, ['p1'], sort=True), show_diff=True)
+
+
+def test_merge_unhashable():
+    # 0-d arrays are not hashable: use list.index
+    M = []
+    for p1 in range(3):
+        m = create_mlut()
+        m.set_attr('p1', np.array(float(p1)))
+        M.append(m)
+    m = merge(M, ['p1'])
+    assert list(m.axes['p1']) == [0., 1., 2.]
+    assert np.allclose(m['data2'].data[2], M[2]['data2'].data)
+
+
+def test_merge_fingerprint():
+    M = [create_mlut() for _ in range(3)]
+    for i, m in enumerate(M):
+        m.set_attr('p1', i)
+    assert M[0].fingerprint() == M[1].fingerprint()
+
+    # compatible MLUT with a different fingerprint
+    M[1].axes['a'] = M[1].axes['a'].astype('float32')
+    assert M[0].fingerprint() != M[1].fingerprint()
+    assert np.allclose(merge(M, ['p1'])['data1'].data[1], M[1]['data1'].data)
+
+    # incompatible MLUT
+    M[2].axes['a'] = M[2].axes['a'] + 1
+    with pytest.raises(AssertionError):
+        merge(M, ['p1'])
+
+    # axes with NaNs are never compatible
+    M = [create_mlut() for _ in range(2)]
+    for i, m in enumerate(M):
+        m.set_attr('p1', i)
+        m.axes['a'] = m.axes['a'].copy()
+        m.axes['a'][0] = np.nan
+    assert M[0].fingerprint() != M[1].fingerprint()
+    with pytest.raises(AssertionError):
+        merge(M, ['p1'])
+
+
+def test_axis_cache_prune():
+    m = create_mlut()
+    for i in range(50):
+        m.axes['a'] = m.axes['a'] + 1.
+        m['data1'].axis_index('a')
+        m['data2'].axis_index('b')
+    assert len(m.axis_cache) == 2
+    l = create_lut()
+    for i in range(50):
+        l.axes[0] = l.axes[0] + 1.
+        l.axis_index(0)
+    assert len(l.axis_cache) == 1
+
+
+def test_mmap_attrs():
+    m0 = create_mlut()
+    attrs = {'arr': np.arange(3, dtype='int16'), 'f32': np.float32(1.5),
+             'tpl': (1, 2), 'b': b'bytes', 's': 'string', 'l': [1, 2.5],
+             'arr2': np.ones((2, 2))}
+    m0.set_attrs(attrs)
+    m0.add_dataset('data4', np.zeros(3), attrs={'arr': np.arange(2.)})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'mlut.mlut')
+        m0.save(filename)
+        m1 = read_mlut(filename)
+    for k, v in attrs.items():
+        assert type(m1.attrs[k]) == type(v)
+        assert np.array_equal(m1.attrs[k], v)
+        if isinstance(v, (np.ndarray, np.generic)):
+            assert m1.attrs[k].dtype == v.dtype
+    assert m1['data4'].attrs['arr'].dtype == np.dtype('float64')